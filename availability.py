@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import datetime
+import fcntl
+import os
+import struct
+
+import numpy as np
+
+MINUTES_PER_DAY = 24 * 60
+# One bit per minute
+PLANE_SIZE = MINUTES_PER_DAY // 8
+# The up and the observed bits of a node
+ROW_SIZE = 2 * PLANE_SIZE
+# Day files grow by this many rows (nodes) at once.
+ROWS_PER_BLOCK = 1024
+# Finished days are stored as runs of minutes, see compact_day(). The header
+# is followed by an index entry per row and the runs of all rows.
+RUNS_MAGIC = b'KAVR'
+RUNS_VERSION = 1
+RUNS_HEADER = struct.Struct('<4sHxxI')  # magic, version, rows
+RUNS_INDEX = struct.Struct('<IHH')  # offset of the runs, observed runs, up runs
+DAY_SUFFIXES = ('.avail', '.bits', '.runs')
+
+_slot_tables = {}
+
+
+class AvailabilityStore:
+    """ Minutely availability history of the nodes. The worker records one
+    observation per cycle, the node page reads ranges of it.
+
+    There is one file per day (YYYY-MM-DD.avail) and one row in it per
+    node, which holds two planes of 1440 bits: the first bit is set, if the
+    node was up in that minute, the second one, if the node has been
+    observed in that minute at all. So missing data (e.g. the shard of the
+    node was not checked, or the node was missing in the nodes.json) is not
+    mistaken for the node being down. For 10,000 nodes a day file takes
+    3.6 MB while it is written.
+
+    Finished days are compacted by retention.py (see compact_day()) into
+    YYYY-MM-DD.runs, which only holds the runs of observed and up minutes:
+    a node, which was up all day, takes 16 bytes. So a year of 10,000 nodes
+    takes about 60 MB plus a few bytes per outage. Days older than
+    AVAILABILITY_RETENTION_DAYS are deleted.
+
+    Older versions wrote YYYY-MM-DD.bits with only the up bits and a shared
+    coverage row 0. These files are still read.
+
+    The row of a node (its slot) is assigned on its first observation and
+    appended to the file "slots" as "nodeid first-observation". Minutes
+    before the first observation of a node are not counted.
+
+    The days are naive local days, like all other times in the db. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._day = None
+        self._bits = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _day_path(self, day, suffix='.avail'):
+        return self._path(day.isoformat() + suffix)
+
+    def slots(self):
+        """ Returns {nodeid: (slot, first observation)}. The file is only
+        parsed again, if it has been appended to. """
+
+        path = self._path('slots')
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return {}
+
+        cached = _slot_tables.get(path)
+        if cached and cached[0] == (st.st_ino, st.st_size):
+            return cached[1]
+
+        slots = {}
+        with open(path) as f:
+            for row, line in enumerate(f, 1):
+                if not line.endswith('\n'):
+                    # not completely written yet
+                    break
+                nodeid, first = line.split()
+                # With several workers, a node might have been added twice.
+                # The row of every line is reserved anyway.
+                slots.setdefault(nodeid, (row, datetime.datetime.fromisoformat(first)))
+
+        _slot_tables[path] = ((st.st_ino, st.st_size), slots)
+        return slots
+
+    def _add_slots(self, nodeids, at):
+        first = at.replace(second=0, microsecond=0).isoformat()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path('slots'), 'a') as f:
+            # several workers might add slots at the same time
+            fcntl.flock(f, fcntl.LOCK_EX)
+            slots = self.slots()
+            f.write(''.join('%s %s\n' % (nodeid, first) for nodeid in nodeids if nodeid not in slots))
+
+    def _open_day(self, day, rows):
+        """ Maps the file of the given day for writing, with at least the
+        given number of rows. """
+
+        if self._day == day and self._bits.shape[0] >= rows:
+            return self._bits
+
+        self._bits = None
+        path = self._day_path(day)
+        needed = -(-rows // ROWS_PER_BLOCK) * ROWS_PER_BLOCK * ROW_SIZE
+
+        with open(path, 'ab') as f:
+            # The size is checked under the lock, so a file extended by
+            # another worker is never truncated again.
+            fcntl.flock(f, fcntl.LOCK_EX)
+            size = os.fstat(f.fileno()).st_size
+            if size < needed:
+                # The file is extended sparsely, so the new rows read as zeros.
+                f.truncate(needed)
+                size = needed
+
+        self._bits = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size // ROW_SIZE, ROW_SIZE))
+        self._day = day
+        return self._bits
+
+    def record(self, at, nodeids, up_nodeids):
+        """ Records an observation of the given nodes at the given time. The
+        nodes in up_nodeids were up, all others in nodeids were not. Nodes,
+        which are not in nodeids, stay unobserved in this minute. """
+
+        slots = self.slots()
+        new = [nodeid for nodeid in nodeids if nodeid not in slots]
+        if new:
+            self._add_slots(new, at)
+            slots = self.slots()
+
+        minute = at.hour * 60 + at.minute
+        byte, mask = minute // 8, np.uint8(0x80 >> (minute % 8))
+
+        up = np.array(sorted(slots[nodeid][0] for nodeid in up_nodeids if nodeid in slots), dtype=np.intp)
+        down = np.array(sorted(slots[nodeid][0] for nodeid in set(nodeids) - set(up_nodeids)), dtype=np.intp)
+
+        bits = self._open_day(at.date(), len(slots) + 1)
+        observed = PLANE_SIZE + byte
+        bits[up, observed] |= mask
+        bits[down, observed] |= mask
+        bits[up, byte] |= mask
+        # a minute might be recorded twice
+        bits[down, byte] &= ~mask
+        bits.flush()
+
+    def _read_bits(self, path, offset, size):
+        """ Returns None, if the file does not exist. """
+
+        try:
+            with open(path, 'rb') as f:
+                data = os.pread(f.fileno(), size, offset)
+        except FileNotFoundError:
+            return None
+
+        # rows beyond the end of the file have not been written yet
+        data = data.ljust(size, b'\0')
+        return np.unpackbits(np.frombuffer(data, dtype=np.uint8)).astype(bool)
+
+    def _read_rows(self, day, lo, hi):
+        """ Returns whether the nodes in the rows [lo, hi) have been
+        observed and whether they were up, as arrays with one row per node
+        and one column per minute of the day. Only the files, which have not
+        been compacted yet, are read. Returns None, if there are none. """
+
+        rows = hi - lo
+        bits = self._read_bits(self._day_path(day), lo * ROW_SIZE, rows * ROW_SIZE)
+        legacy = self._day_path(day, '.bits')
+        legacy_bits = self._read_bits(legacy, lo * PLANE_SIZE, rows * PLANE_SIZE)
+        if bits is None and legacy_bits is None:
+            return None
+
+        covered = np.zeros((rows, MINUTES_PER_DAY), dtype=bool)
+        up = np.zeros((rows, MINUTES_PER_DAY), dtype=bool)
+
+        if bits is not None:
+            bits = bits.reshape(rows, 2 * MINUTES_PER_DAY)
+            up, covered = bits[:, :MINUTES_PER_DAY], bits[:, MINUTES_PER_DAY:]
+
+        if legacy_bits is not None:
+            legacy_covered = self._read_bits(legacy, 0, PLANE_SIZE)
+            if legacy_covered is not None:
+                up = up | (legacy_bits.reshape(rows, MINUTES_PER_DAY) & legacy_covered)
+                covered = covered | legacy_covered
+
+        return covered, up
+
+    def _read_runs(self, day, row):
+        """ Same as _read_rows() for a single row, but from the compacted
+        file. Returns None, if the day has not been compacted. """
+
+        try:
+            f = open(self._day_path(day, '.runs'), 'rb')
+        except FileNotFoundError:
+            return None
+
+        covered = np.zeros(MINUTES_PER_DAY, dtype=bool)
+        up = np.zeros(MINUTES_PER_DAY, dtype=bool)
+
+        with f:
+            magic, version, rows = RUNS_HEADER.unpack(os.pread(f.fileno(), RUNS_HEADER.size, 0))
+            if magic != RUNS_MAGIC or version != RUNS_VERSION:
+                raise ValueError('unknown format of ' + f.name)
+            if row >= rows:
+                return covered, up
+
+            offset, covered_runs, up_runs = RUNS_INDEX.unpack(
+                os.pread(f.fileno(), RUNS_INDEX.size, RUNS_HEADER.size + row * RUNS_INDEX.size))
+            runs = np.frombuffer(os.pread(f.fileno(), 4 * (covered_runs + up_runs), offset), dtype='<u2')
+
+        runs = runs.reshape(-1, 2)
+        for plane, plane_runs in [(covered, runs[:covered_runs]), (up, runs[covered_runs:])]:
+            for start, stop in plane_runs:
+                plane[start:stop] = True
+
+        return covered, up
+
+    def _read_day(self, day, row):
+        """ Returns whether the node in the given row has been observed and
+        whether it was up, for every minute of the day. """
+
+        runs = self._read_runs(day, row)
+        if runs is not None:
+            return runs
+
+        bits = self._read_rows(day, row, row + 1)
+        if bits is not None:
+            return bits[0][0], bits[1][0]
+
+        # the day might have been compacted in the meantime
+        runs = self._read_runs(day, row)
+        if runs is not None:
+            return runs
+
+        return np.zeros(MINUTES_PER_DAY, dtype=bool), np.zeros(MINUTES_PER_DAY, dtype=bool)
+
+    def read(self, nodeid, start, end):
+        """ Returns two arrays with one entry per minute in [start, end):
+        whether there is an observation for the node in this minute, and
+        whether the node was up. Only one small read per day is done. """
+
+        start = start.replace(second=0, microsecond=0)
+        # the current, incomplete minute is included
+        if end.second or end.microsecond:
+            end = end.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        minutes = max(int((end - start).total_seconds() // 60), 0)
+
+        covered = np.zeros(minutes, dtype=bool)
+        up = np.zeros(minutes, dtype=bool)
+
+        slot = self.slots().get(nodeid)
+        if slot is None or minutes == 0:
+            return covered, up
+        row, first = slot
+
+        day = start.date()
+        while day <= (end - datetime.timedelta(minutes=1)).date():
+            day_start = datetime.datetime.combine(day, datetime.time())
+            # position of this day in the result
+            offset = int((day_start - start).total_seconds() // 60)
+            lo, hi = max(-offset, 0), min(minutes - offset, MINUTES_PER_DAY)
+
+            day_covered, day_up = self._read_day(day, row)
+            covered[offset + lo:offset + hi] = day_covered[lo:hi]
+            up[offset + lo:offset + hi] = day_up[lo:hi]
+            day += datetime.timedelta(days=1)
+
+        if first > start:
+            covered[:int((first - start).total_seconds() // 60)] = False
+
+        return covered, up & covered
+
+    def availability(self, nodeid, start, end):
+        """ Returns the fraction of observed minutes in [start, end), in
+        which the node was up, or None if there are no observations. """
+
+        covered, up = self.read(nodeid, start, end)
+        observed = np.count_nonzero(covered)
+        if observed == 0:
+            return None
+        return np.count_nonzero(up) / observed
+
+    def days(self):
+        """ Returns the days, which have a file, in order. """
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        days = set()
+        for name in names:
+            stem, suffix = os.path.splitext(name)
+            if suffix not in DAY_SUFFIXES:
+                continue
+            try:
+                days.add(datetime.date.fromisoformat(stem))
+            except ValueError:
+                continue
+
+        return sorted(days)
+
+    def compact_day(self, day):
+        """ Replaces the files of a finished day by YYYY-MM-DD.runs, which
+        holds the runs of observed and of up minutes of every node. Returns
+        False, if there is nothing to compact. The day must not be recorded
+        anymore. """
+
+        sizes = []
+        for suffix, row_size in [('.avail', ROW_SIZE), ('.bits', PLANE_SIZE)]:
+            try:
+                sizes += [os.path.getsize(self._day_path(day, suffix)) // row_size]
+            except FileNotFoundError:
+                pass
+
+        if not sizes:
+            return False
+        # the files grow by whole blocks, the rows after the last slot are empty
+        rows = min(max(sizes), max((row for row, _ in self.slots().values()), default=0) + 1)
+
+        index, data = bytearray(), bytearray()
+        data_offset = RUNS_HEADER.size + rows * RUNS_INDEX.size
+
+        for lo in range(0, rows, ROWS_PER_BLOCK):
+            hi = min(lo + ROWS_PER_BLOCK, rows)
+            covered, up = self._read_rows(day, lo, hi)
+            covered_runs, covered_counts = _runs(covered)
+            up_runs, up_counts = _runs(up & covered)
+
+            c = u = 0
+            for covered_count, up_count in zip(covered_counts, up_counts):
+                index += RUNS_INDEX.pack(data_offset + len(data), covered_count, up_count)
+                data += covered_runs[c:c + covered_count].tobytes()
+                data += up_runs[u:u + up_count].tobytes()
+                c += covered_count
+                u += up_count
+
+        path = self._day_path(day, '.runs')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(RUNS_HEADER.pack(RUNS_MAGIC, RUNS_VERSION, rows))
+            f.write(index)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        for suffix in ['.avail', '.bits']:
+            try:
+                os.unlink(self._day_path(day, suffix))
+            except FileNotFoundError:
+                pass
+
+        return True
+
+    def delete_day(self, day):
+        for suffix in DAY_SUFFIXES:
+            try:
+                os.unlink(self._day_path(day, suffix))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._bits = None
+        self._day = None
+
+
+def _runs(bits):
+    """ Returns the runs of set bits in every row of bits as an array of
+    (first minute, minute after the last) and the number of runs per row. """
+
+    edges = np.diff(np.pad(bits.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+    runs = np.stack([starts, stops], axis=1).astype('<u2')
+    return runs, np.bincount(rows, minlength=bits.shape[0])
@@ -0,0 +1,5 @@
+""" Benchmarks for the worker cycle against a synthetic mesh.
+
+    python -m bench.run --nodes 1000 10000 100000 --output bench.json
+    python -m bench.compare old.json new.json
+"""
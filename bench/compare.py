@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+""" Compares two result files of bench/run.py by the median times.
+
+    python -m bench.compare old.json new.json [--threshold 1.2]
+
+Exits with 1, if a benchmark got slower by more than the threshold. """
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data, {(r['benchmark'], r['nodes']): r for r in data['results']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    old_data, old = load(args.old)
+    new_data, new = load(args.new)
+
+    print("old: %s\nnew: %s\n" % (old_data.get('commit'), new_data.get('commit')))
+
+    regressions = 0
+    for key in new:
+        if key not in old:
+            continue
+
+        ratio = new[key]['median'] / old[key]['median']
+        mark = ''
+        if ratio > args.threshold:
+            mark = '  <-- slower'
+            regressions += 1
+
+        print("%-55s %7d nodes: %8.2f ms -> %8.2f ms (x%.2f)%s" %
+              (key[0], key[1], old[key]['median'] * 1000, new[key]['median'] * 1000, ratio, mark))
+
+    sys.exit(1 if regressions else 0)
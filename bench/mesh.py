@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import random
+
+
+class SyntheticMesh:
+    """ Generates nodes.json files of a made up mesh. Every call of step()
+    advances the time by one worker cycle:
+
+    - nodes, which are online, are seen again with a delay of up to
+      lastseen_jitter seconds
+    - a fraction (offline_fraction) of the nodes is offline and is not seen
+      anymore; their lastseen lies up to offline_spread in the past
+    - churn_rate is the fraction of nodes, which goes offline or comes back
+      online in each step
+
+    The same seed always produces the same mesh. """
+
+    def __init__(self, count, offline_fraction=0.1, offline_spread=datetime.timedelta(days=2),
+                 lastseen_jitter=60, churn_rate=0.01, seed=0, now=None):
+        self.random = random.Random(seed)
+        self.now = now or datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.lastseen_jitter = lastseen_jitter
+        self.churn_rate = churn_rate
+        self.offline_spread = offline_spread
+
+        self.nodeids = ['%012x' % self.random.getrandbits(48) for _ in range(count)]
+        self.hostnames = {nodeid: 'node-%d' % i for i, nodeid in enumerate(self.nodeids)}
+        self.lastseen = {}
+        self.online = {}
+
+        for nodeid in self.nodeids:
+            self.online[nodeid] = self.random.random() >= offline_fraction
+            if self.online[nodeid]:
+                self.lastseen[nodeid] = self._seen()
+            else:
+                self.lastseen[nodeid] = self.now - self.offline_spread * self.random.random()
+
+    def _seen(self):
+        return self.now - datetime.timedelta(seconds=self.random.uniform(0, self.lastseen_jitter))
+
+    def step(self, seconds=60):
+        self.now += datetime.timedelta(seconds=seconds)
+
+        for nodeid in self.random.sample(self.nodeids, int(len(self.nodeids) * self.churn_rate)):
+            self.online[nodeid] = not self.online[nodeid]
+
+        for nodeid in self.nodeids:
+            if self.online[nodeid]:
+                self.lastseen[nodeid] = self._seen()
+
+    def timestamp(self):
+        return self.now.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    def nodes_json(self):
+        """ Returns the nodes.json (meshviewer format) as bytes. """
+
+        def fmt(t):
+            return t.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+        nodes = [{
+            'firstseen': fmt(self.now - datetime.timedelta(days=365)),
+            'lastseen': fmt(self.lastseen[nodeid]),
+            'flags': {'online': self.online[nodeid], 'gateway': False},
+            'statistics': {'node_id': nodeid, 'clients': self.random.randint(0, 20)},
+            'nodeinfo': {
+                'node_id': nodeid,
+                'hostname': self.hostnames[nodeid],
+                'network': {'mac': ':'.join(nodeid[i:i + 2] for i in range(0, 12, 2))},
+                'software': {'firmware': {'release': 'v2024.1'}},
+            },
+        } for nodeid in self.nodeids]
+
+        return json.dumps({'timestamp': self.timestamp(), 'version': 2, 'nodes': nodes}).encode('utf-8')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+""" Times the steps of a ping_worker.py cycle against a synthetic mesh, which
+is served from a local http server. Every node of the mesh is in the db (the
+worst case for the worker). The database is a scratch database, config.py is
+only needed for the other settings.
+
+    python -m bench.run --nodes 1000 10000 100000 --repeat 5 --output bench.json
+
+The results are written as json, see bench/compare.py. """
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import main
+
+BENCHMARKS = [
+    # the first download of a new cache: everything is parsed
+    'NodesJSONCache.update',
+    # as in ping_worker.py: filtered by the nodes in the db and published
+    # as snapshot
+    'NodesJSONCache.update(filter_nodeids, snapshot_path)',
+    'NodeSet.update_from_db',
+    # as in ping_worker.py: only new and deleted nodes are loaded
+    'NodeSet.refresh',
+    'NodesJSONCache.update_db_nodes',
+    # as in ping_worker.py: only changed nodes are written
+    'NodeSet.sync',
+    'NodeSet.check',
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(main.__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def timed(times, name, fn):
+    gc.collect()
+    start = time.perf_counter()
+    result = fn()
+    times[name] += [time.perf_counter() - start]
+    return result
+
+
+def run(count, repeat, workdir, args):
+    from main import NodesJSONCache, NodeSet, Node, Alarm, get_session, init_db
+    from bench.mesh import SyntheticMesh
+    from bench.server import NodesJSONServer
+
+    mesh = SyntheticMesh(count, offline_fraction=args.offline_fraction,
+                         churn_rate=args.churn_rate, seed=args.seed)
+    times = {name: [] for name in BENCHMARKS}
+    snapshot_path = os.path.join(workdir, 'nodes.snapshot')
+
+    session = get_session()
+    # the session of the worker, see ping_worker.py
+    worker_session = get_session(expire_on_commit=False)
+    session.query(Alarm).delete()
+    session.query(Node).delete()
+    session.commit()
+
+    with NodesJSONServer() as server:
+        server.publish(mesh.nodes_json())
+
+        # Every node of the mesh goes into the db. The first check moves
+        # them from 'new' to their actual state.
+        cache = NodesJSONCache(server.url)
+        cache.update()
+        session.add_all(cache.nodes)
+        session.commit()
+
+        nodeset = NodeSet()
+        nodeset.update_from_db(worker_session)
+        nodeset.check(worker_session)
+
+        worker_cache = NodesJSONCache(server.url)
+        # all nodes, as update_db_nodes() writes them, see below
+        legacy_nodeset = NodeSet()
+
+        for _ in range(repeat):
+            mesh.step()
+            server.publish(mesh.nodes_json())
+
+            timed(times, 'NodesJSONCache.update', lambda: NodesJSONCache(server.url).update())
+
+            timed(times, 'NodeSet.update_from_db', lambda: legacy_nodeset.update_from_db(session))
+            timed(times, 'NodeSet.refresh', lambda: nodeset.refresh(worker_session))
+
+            filter_nodeids = {n.nodeid for n in nodeset.nodes}
+            timed(times, 'NodesJSONCache.update(filter_nodeids, snapshot_path)',
+                  lambda: worker_cache.update(filter_nodeids=filter_nodeids, snapshot_path=snapshot_path))
+
+            def update_db_nodes():
+                worker_cache.update_db_nodes(legacy_nodeset.nodes)
+                session.add_all(legacy_nodeset.nodes)
+                session.commit()
+
+            timed(times, 'NodesJSONCache.update_db_nodes', update_db_nodes)
+            timed(times, 'NodeSet.sync', lambda: nodeset.sync(worker_session, worker_cache))
+            timed(times, 'NodeSet.check', lambda: nodeset.check(worker_session))
+
+    session.close()
+    worker_session.close()
+
+    return [{
+        'benchmark': name,
+        'nodes': count,
+        'min': min(times[name]),
+        'median': statistics.median(times[name]),
+        'times': times[name],
+    } for name in BENCHMARKS]
+
+
+def run_all():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--offline-fraction', type=float, default=0.1)
+    parser.add_argument('--churn-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='keepitup-bench-')
+    # main has to use the scratch db, before any engine is created
+    main.SQLITE_URI = 'sqlite:///' + os.path.join(workdir, 'data.db')
+    main.init_db()
+
+    results = []
+    for count in args.nodes:
+        for result in run(count, args.repeat, workdir, args):
+            print("%-55s %7d nodes: median %8.2f ms, min %8.2f ms" %
+                  (result['benchmark'], count, result['median'] * 1000, result['min'] * 1000))
+            results += [result]
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'results': results,
+        }, f, indent=2)
+
+    print("results written to " + args.output)
+
+
+if __name__ == '__main__':
+    run_all()
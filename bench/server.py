@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class NodesJSONServer:
+    """ Serves a nodes.json from memory on localhost, like the map server
+    does: with ETag, 304 Not Modified and gzip if the client asks for it.
+    Call publish() to serve a new file. """
+
+    def __init__(self):
+        self.body = b''
+        self.gzip_body = b''
+        self.etag = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                body = server.body
+                use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', server.etag)
+                if use_gzip:
+                    body = server.gzip_body
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/nodes.json' % self.httpd.server_address[1]
+
+    def publish(self, body):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=1)
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+""" Measures the startup of the entry points with python -X importtime:
+print_stats.py against a scratch database, ping_worker.py up to its argument
+parsing (run with --help, all imports are done by then) and the boot of a
+gunicorn worker (loading webserver:app, like gunicorn --check-config does).
+
+    python -m bench.startup --nodes 1000 --repeat 5 --output startup.json
+
+For every entry point, the total import time and the wall time of the
+process are recorded. The results are written in the format of
+bench/run.py, so they can be compared with bench/compare.py as well. """
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import main
+from bench.run import git_commit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    'print_stats.py': ['print_stats.py'],
+    'ping_worker.py': ['ping_worker.py', '--help'],
+    # without --preload, every gunicorn worker imports the app like this
+    'gunicorn worker boot': ['gunicorn', '--check-config', 'webserver:app'],
+}
+
+# Runs an entry point against the scratch database. All entry points import
+# main anyway, so importing it first does not change the import time.
+LAUNCHER = """
+import runpy, sys
+import main
+main.SQLITE_URI = sys.argv[1]
+sys.argv = sys.argv[2:]
+try:
+    if sys.argv[0].endswith('.py'):
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    else:
+        runpy.run_module(sys.argv[0], run_name='__main__', alter_sys=True)
+except SystemExit as e:
+    if e.code:
+        raise
+"""
+
+
+def parse_importtime(stderr):
+    """ Returns the total import time in seconds and the toplevel imports
+    as {module: cumulative seconds}. """
+
+    toplevel = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        # nested imports are indented by two more spaces
+        if not cumulative.strip().isdigit() or name.startswith('  '):
+            continue
+        toplevel[name.strip()] = int(cumulative) / 1e6
+
+    return sum(toplevel.values()), toplevel
+
+
+def measure(argv, sqlite_uri):
+    start = time.perf_counter()
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', LAUNCHER, sqlite_uri] + argv,
+                         cwd=REPO_DIR, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    if res.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(argv), res.stderr[-2000:]))
+
+    total, toplevel = parse_importtime(res.stderr)
+    return total, wall, toplevel
+
+
+def populate(count):
+    session = main.get_session()
+    session.add_all([main.Node('bench%d' % i, 'bench-nodeid%d' % i) for i in range(count)])
+    session.commit()
+    session.close()
+
+
+def run_all():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5, help="number of the slowest toplevel imports to print")
+    parser.add_argument('--output', default='startup.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='keepitup-bench-')
+    main.SQLITE_URI = 'sqlite:///' + os.path.join(workdir, 'data.db')
+    main.init_db()
+    populate(args.nodes)
+
+    results = []
+    for name, argv in ENTRY_POINTS.items():
+        # the first run also compiles the bytecode
+        measure(argv, main.SQLITE_URI)
+
+        imports, walls = [], []
+        for _ in range(args.repeat):
+            total, wall, toplevel = measure(argv, main.SQLITE_URI)
+            imports += [total]
+            walls += [wall]
+
+        for benchmark, times in [(name + ' (imports)', imports), (name + ' (wall)', walls)]:
+            result = {
+                'benchmark': benchmark,
+                'nodes': args.nodes,
+                'min': min(times),
+                'median': statistics.median(times),
+                'times': times,
+            }
+            print("%-55s %7d nodes: median %8.2f ms, min %8.2f ms" %
+                  (benchmark, args.nodes, result['median'] * 1000, result['min'] * 1000))
+            results += [result]
+
+        slowest = sorted(toplevel.items(), key=lambda item: -item[1])[:args.top]
+        print('    slowest imports: ' + ', '.join('%s %.1f ms' % (module, t * 1000) for module, t in slowest))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+
+    print("results written to " + args.output)
+
+
+if __name__ == '__main__':
+    run_all()
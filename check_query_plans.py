@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+""" Runs the queries of the worker and the webserver against a small
+database and checks their plans with EXPLAIN QUERY PLAN. If a query scans a
+whole table, which it is not expected to scan, the check fails. Run this
+after every change of the models, the queries or the migrations:
+
+    ./check_query_plans.py            # fresh database from migrate.py
+    ./check_query_plans.py data.db    # a copy of an existing database
+
+Exits with 1, if any check failed. """
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+import main
+
+if __name__ == '__main__':
+    # The checks write some test data, so they never run on the given
+    # database itself.
+    db_path = os.path.join(tempfile.mkdtemp(), 'data.db')
+    main.SQLITE_URI = 'sqlite:///' + db_path
+
+    if len(sys.argv) > 1:
+        with sqlite3.connect(db_path) as dst:
+            sqlite3.connect(sys.argv[1]).backup(dst)
+
+from main import *
+import migrate
+import webserver
+
+
+def populate(session):
+    now = datetime.datetime.now()
+    users = [User(email='check%d@example.com' % i) for i in range(2)]
+    session.add_all(users)
+
+    for i in range(4):
+        node = Node('check%d' % i, 'check-nodeid%d' % i)
+        node.last_seen_at = now
+        node.last_updated_at = now
+        session.add(node)
+        session.add(Subscription(user=users[i % 2], node=node))
+
+        alarm = Alarm(node=node, alarm_at=now, resolved_at=now)
+        session.add(alarm)
+        session.add(OutboxMail(user=users[i % 2], alarm=alarm, kind='alarm'))
+
+    session.commit()
+
+
+class QueryRecorder:
+
+    def __init__(self):
+        self.statements = []
+        for readonly in [False, True]:
+            event.listen(get_engine(readonly), 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            self.statements += [(statement, parameters)]
+
+
+def scanned_tables(session, statement, parameters):
+    """ Returns the tables, which are scanned completely by the statement,
+    and the whole plan. """
+
+    if isinstance(parameters, list):
+        parameters = parameters[0] if parameters else ()
+
+    plan = session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    details = [row[-1] for row in plan]
+
+    # e.g. 'SCAN nodes' or 'SCAN alarms USING COVERING INDEX ...'
+    tables = {detail.split()[1] for detail in details if detail.startswith('SCAN ')}
+    return tables, details
+
+
+def checks(session, recorder):
+    """ (name, function, tables which may be scanned completely) """
+
+    node = Node.find_by_nodeid(session, 'check-nodeid0')
+    user = User.find_by_email(session, 'check0@example.com')
+    mail = session.query(OutboxMail).filter(OutboxMail.kind == 'alarm').first()
+
+    def expire():
+        session.expire_all()
+
+    def node_refresh():
+        # refresh() expunges nodes, so it gets a session of its own
+        worker_session = get_session(expire_on_commit=False)
+        nodeset = NodeSet()
+        nodeset.update_from_db(worker_session)
+        nodeset.watermark = 0
+        recorder.statements.clear()
+        nodeset.refresh(worker_session)
+        worker_session.close()
+
+    def node_check():
+        nodeset = NodeSet()
+        nodeset.update_from_db(session)
+        for n in nodeset.nodes:
+            n.last_seen_at = datetime.datetime.now() - 2 * NODE_OFFLINE_TIMEOUT
+        session.flush()
+        recorder.statements.clear()
+        nodeset.check(session)
+
+    return [
+        ('NodeSet.update_from_db', lambda: NodeSet().update_from_db(session), {'nodes'}),
+        # node_changes only holds the changes of NODE_CHANGES_RETENTION
+        ('NodeSet.refresh', node_refresh, {'node_changes'}),
+        ('Node.find_by_nodeid', lambda: Node.find_by_nodeid(session, 'check-nodeid1'), set()),
+        ('User.find_by_email', lambda: User.find_by_email(session, 'check1@example.com'), set()),
+        ('Node.get_subscription_by_user', lambda: node.get_subscription_by_user(session, user), set()),
+        ('Node.latest_alarm', lambda: node.latest_alarm(session), set()),
+        ('Node.open_alarm', lambda: node.open_alarm(session), set()),
+        ('Node.alarm_page', lambda: node.alarm_page(session, before=100), set()),
+        ('Node.subscriptions', lambda: (expire(), node.subscriptions), set()),
+        ('User.subscriptions', lambda: (expire(), user.subscriptions), set()),
+        ('Node.status_rows (nodeids)', lambda: Node.status_rows(session, nodeids=['check-nodeid1', 'check-nodeid2']).all(), set()),
+        ('Node.status_rows (constitution)', lambda: Node.status_rows(session, constitution='problem').all(), set()),
+        # the unknown nodes are not indexed, there are usually few of them
+        ('Node.status_rows (unknown)', lambda: Node.status_rows(session, constitution='unknown').all(), {'nodes'}),
+        ('AlarmRollup.fold', lambda: AlarmRollup.fold(session, datetime.datetime.now() - datetime.timedelta(days=1), 100), set()),
+        ('AlarmRollup.totals', lambda: AlarmRollup.totals(session, node), set()),
+        ('NodeEvent.since', lambda: NodeEvent.since(session, 0), set()),
+        ('DataVersion.get', lambda: DataVersion.get(session), set()),
+        ('OutboxMail.due', lambda: OutboxMail.due(session, datetime.datetime.now(), 100), set()),
+        # walks ix_outbox_pending, which only holds the unsent mails
+        ('OutboxMail.due (user_ids)', lambda: OutboxMail.due(session, datetime.datetime.now(), None, user_ids=[user.id]), {'outbox'}),
+        ('OutboxMail.find_alarm_mail', lambda: mail.find_alarm_mail(session), set()),
+        # node_events only holds the events of NODE_EVENTS_RETENTION
+        ('NodeSet.check', node_check, {'node_events'}),
+        ('webserver.get_sidebar', lambda: webserver.get_sidebar(session, user), {'nodes'}),
+    ]
+
+
+def run_checks(session):
+    """ Runs all checks against the populated session. Yields the name of
+    every check and the statements, which scan more tables than allowed, as
+    (tables, statement, plan). """
+
+    recorder = QueryRecorder()
+
+    for name, fn, allowed in checks(session, recorder):
+        recorder.statements.clear()
+        fn()
+        failures = []
+
+        for statement, parameters in list(recorder.statements):
+            tables, details = scanned_tables(session, statement, parameters)
+            if tables - allowed:
+                failures += [(tables - allowed, statement, details)]
+
+        yield name, failures
+
+
+if __name__ == '__main__':
+    migrate.migrate()
+
+    session = get_session()
+    populate(session)
+    failed = False
+
+    for name, failures in run_checks(session):
+        for tables, statement, details in failures:
+            print("FAIL " + name + ": scans " + ", ".join(sorted(tables)))
+            print("    " + " ".join(statement.split()))
+            for detail in details:
+                print("    -> " + detail)
+
+        if not failures:
+            print("ok   " + name)
+        failed = failed or bool(failures)
+
+    session.rollback()
+    sys.exit(1 if failed else 0)
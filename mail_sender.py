@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+from main import *
+from mails import SMTPConnection
+from metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+# Number of mails, which are taken from the outbox at once.
+BATCH_SIZE = 100
+# Seconds to wait, if the outbox is empty.
+POLL_INTERVAL = 5
+
+metrics = Metrics(METRICS_DIR, 'mailer')
+
+
+def send_all(conn, jobs):
+    """ Sends the messages one after another over the same connection.
+    Returns the exceptions (or None) in the order of the jobs. """
+
+    results = []
+    for msg, to_addr in jobs:
+        try:
+            with metrics.time('keepitup_smtp_send_seconds'):
+                conn.send(msg, to_addr)
+            results += [None]
+        except Exception as e:
+            # the connection is in an unknown state now
+            conn.close()
+            results += [e]
+
+    return results
+
+
+def render_user_mails(session, mails, now):
+    """ Renders the due mails of a single user. If they are about more than
+    one node, they are combined into one digest. Otherwise they are sent one
+    by one as before, so resolved mails stay replies to their alarm mail.
+    Returns a list of (mails, message). """
+
+    pending = []
+    for mail in mails:
+        if mail.alarm is None or mail.alarm.node is None:
+            # The node has been deleted by an older version, which kept the
+            # mails, see Node.delete().
+            mail.drop('the node has been deleted')
+            metrics.inc('keepitup_mails_total', result='dropped')
+        else:
+            pending += [mail]
+    mails = pending
+
+    if not mails:
+        return []
+
+    if len({mail.alarm.node_id for mail in mails}) > 1:
+        return [(mails, OutboxMail.render_digest(mails))]
+
+    jobs = []
+    for mail in mails:
+        msg = mail.render(session)
+        if msg is None:
+            # The alarm mail this one replies to is still being retried.
+            mail.next_attempt_at = now + datetime.timedelta(seconds=POLL_INTERVAL)
+            continue
+        jobs += [([mail], msg)]
+    return jobs
+
+
+def drain(session, pool, connections):
+    """ Sends all mails from the outbox, which are due. Returns the number of
+    mails, which have been sent or have failed. """
+
+    now = datetime.datetime.now()
+    mails = OutboxMail.due(session, now, BATCH_SIZE)
+    if not mails:
+        return 0
+
+    # All due mails of these users are handled at once, so every user gets
+    # a single digest, even if the batch has split their mails.
+    by_user = {}
+    for mail in OutboxMail.due(session, now, None, user_ids={mail.user_id for mail in mails}):
+        by_user.setdefault(mail.user_id, []).append(mail)
+
+    # All mails to a user are sent over the same connection and in order,
+    # so an alarm mail always arrives before the resolved mail.
+    groups = [[] for _ in connections]
+    handled = 0
+    for user_id, user_mails in by_user.items():
+        try:
+            jobs = render_user_mails(session, user_mails, now)
+        except Exception as e:
+            # A broken mail must not hold up the mails of everybody else.
+            print("warning: rendering the mails to user " + str(user_id) + " failed: " + repr(e), file=sys.stderr)
+            for mail in user_mails:
+                if mail.attempts >= MAIL_MAX_ATTEMPTS:
+                    # dropped already
+                    continue
+                mail.mark_failed(now, e)
+                metrics.inc('keepitup_mails_total', result='failed')
+            handled += len(user_mails)
+            continue
+
+        for job_mails, msg in jobs:
+            groups[user_id % len(connections)] += [(job_mails, msg)]
+            handled += len(job_mails)
+            if len(job_mails) > 1:
+                metrics.inc('keepitup_mail_digests_total')
+
+    # Persist the msgids, before anything is sent.
+    session.commit()
+
+    futures = []
+    for conn, group in zip(connections, groups):
+        if group:
+            jobs = [(msg, job_mails[0].user.email) for job_mails, msg in group]
+            futures += [(group, pool.submit(send_all, conn, jobs))]
+
+    now = datetime.datetime.now()
+    for group, future in futures:
+        for (job_mails, msg), error in zip(group, future.result()):
+            for mail in job_mails:
+                if error is None:
+                    mail.mark_sent(now)
+                    metrics.inc('keepitup_mails_total', result='sent')
+                else:
+                    print("warning: mail " + str(mail.id) + " to " + mail.user.email + " failed: " + str(error), file=sys.stderr)
+                    mail.mark_failed(now, error)
+                    metrics.inc('keepitup_mails_total', result='failed')
+
+    session.commit()
+    metrics.publish()
+    return handled
+
+
+if __name__ == '__main__':
+    session = get_session()
+    connections = [SMTPConnection() for _ in range(MAIL_SENDER_CONNECTIONS)]
+    pool = ThreadPoolExecutor(max_workers=MAIL_SENDER_CONNECTIONS)
+
+    print("mail_sender.py, using " + str(MAIL_SENDER_CONNECTIONS) + " smtp connections.")
+
+    try:
+        while True:
+            if drain(session, pool, connections) == 0:
+                # Do not keep idle connections open.
+                for conn in connections:
+                    conn.close()
+                time.sleep(POLL_INTERVAL)
+
+    except KeyboardInterrupt:
+        print("CTRL + C pressed. Exiting.")
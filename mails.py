@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+""" Rendering and sending of the mails. main.py only imports this, when a
+mail is actually built, so the entry points, which never send mails, do not
+pay for smtplib and the email package. """
+
+import datetime
+import gettext
+import os
+import smtplib, ssl
+from email.utils import make_msgid
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import Header
+from email.charset import Charset, QP
+
+import pytz
+
+from config import *
+
+TRANSLATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translations')
+
+_mail_templates = None
+
+
+def get_mail_templates():
+    """ Returns the mail templates of all languages, which have a compiled
+    catalog in translations/. The catalogs are only read once per process:
+    {language: {name: {"subject": ..., "message": ...}}} """
+
+    global _mail_templates
+
+    if _mail_templates is not None:
+        return _mail_templates
+
+    templates = {}
+    for language in sorted(os.listdir(TRANSLATIONS_DIR)):
+        mo_file = os.path.join(TRANSLATIONS_DIR, language, 'LC_MESSAGES', 'messages.mo')
+        if not os.path.exists(mo_file):
+            continue
+
+        with open(mo_file, 'rb') as f:
+            t = gettext.GNUTranslations(f)
+
+        # The msgids are spelled out, so pybabel can extract them.
+        templates[language] = {
+            'confirm': {"subject": t.gettext("mail:confirm:subject"),
+                        "message": t.gettext("mail:confirm:message")},
+            'alarm': {"subject": t.gettext("mail:alarm:subject"),
+                      "message": t.gettext("mail:alarm:message")},
+            'resolved': {"subject": t.gettext("mail:resolved:subject"),
+                         "message": t.gettext("mail:resolved:message")},
+            # one line per alarm or resolved alarm in the message
+            'digest': {"subject": t.gettext("mail:digest:subject"),
+                       "message": t.gettext("mail:digest:message"),
+                       "alarm": t.gettext("mail:digest:alarm"),
+                       "resolved": t.gettext("mail:digest:resolved")},
+        }
+
+    if 'en' not in templates:
+        raise FileNotFoundError('No compiled translations found in ' + TRANSLATIONS_DIR + '. Please run ./translate.sh compile.')
+
+    _mail_templates = templates
+    return templates
+
+
+def build_message(to_addr, mail_template, in_reply_to=None, msgid=None, **kwargs):
+    """ Renders a mail. Returns the message, which can be passed to
+    SMTPConnection.send() along with to_addr. """
+
+    if msgid is None:
+        msgid = make_msgid()
+
+    subject = mail_template['subject'].format(**kwargs)
+    message = mail_template['message'].format(**kwargs)
+
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = str(Header(subject, 'utf-8'))
+    msg['From'] = str(Header(SMTP_FROM, 'utf-8'))
+    msg['To'] = str(Header(to_addr, 'utf-8'))
+    msg['Message-ID'] = msgid
+    msg['Reply-To'] = SMTP_REPLY_TO_EMAIL
+    msg['Date'] = datetime.datetime.now(pytz.utc).strftime("%a, %e %b %Y %T %z")
+
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+        msg['References'] = in_reply_to
+
+    # add message
+    charset = Charset('utf-8')
+    # QP = quoted printable; this is better readable instead of base64, when
+    # the mail is read in plaintext!
+    charset.body_encoding = QP
+    message_part = MIMEText(message.encode('utf-8'), 'plain', charset)
+    msg.attach(message_part)
+
+    return msg
+
+
+class SMTPConnection:
+    """ A connection to the SMTP server, which can be used to send many mails
+    in a row. The connection is opened on the first send() and reopened, if
+    the server has closed it in the meantime. In DEBUG mode, the mails are
+    only written to /tmp/keepitup_mails.log. """
+
+    def __init__(self):
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+        server.ehlo()
+        if SMTP_USE_STARTTLS:
+            context = ssl.create_default_context()
+            server.starttls(context=context)
+        if SMTP_USER:
+            server.login(SMTP_USER, SMTP_PASS)
+        self.server = server
+
+    def send(self, msg, to_addr):
+        if DEBUG:
+            with open("/tmp/keepitup_mails.log", "a") as f:
+                f.write(msg.as_string() + "\n")
+            return
+
+        if self.server is None:
+            self._connect()
+
+        try:
+            self.server.sendmail(SMTP_FROM, to_addr, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # the server has closed an idle connection, so try once again
+            self._connect()
+            self.server.sendmail(SMTP_FROM, to_addr, msg.as_string())
+
+    def close(self):
+        if self.server is None:
+            return
+
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            pass
+        self.server = None
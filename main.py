@@ -1,34 +1,92 @@
 #!/usr/bin/env python3
 
-from dateutil.parser import parse as parse_time
-import numpy as np
+""" The models and the settings of all entry points. Heavy modules are only
+imported where they are needed (mails.py, numpy, requests, flask), so every
+entry point starts fast, see bench/startup.py. """
+
+import json
+import os
 import sys
-import time
-import pytz
-import pprint
 import secrets
 import datetime
-import gettext
-import requests
-import smtplib, ssl
-from email.utils import make_msgid
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.header import Header
-from email.charset import Charset, QP
-from flask_babel import get_locale as flask_get_locale
-
-from sqlalchemy import create_engine, func, event
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Sequence, Boolean, DateTime, ForeignKey
-from sqlalchemy.orm import sessionmaker,relationship,column_property
+import zlib
+
+from sqlalchemy import create_engine, func, event, bindparam, select, text, inspect
+from sqlalchemy import Column, Integer, String, Sequence, Boolean, Date, DateTime, Float, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, declarative_base, sessionmaker, relationship, column_property
+from sqlalchemy.sql import Insert, Update, Delete
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import case
 
+# Defaults for settings, which can be overwritten in config.py
+SQLITE_URI = 'sqlite:///' + os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.db')
+# Applied to every new sqlite connection. WAL allows the webserver to read,
+# while the worker is writing.
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16 * 1024,  # KiB
+    'busy_timeout': 10000,  # ms
+}
+NODES_SNAPSHOT_PATH = 'nodes.snapshot'
+AVAILABILITY_DIR = 'availability'
+# Every process publishes its metrics here, see webserver.py /metrics.
+METRICS_DIR = 'metrics'
+# The worker starts a cycle every WORKER_INTERVAL seconds. If
+# WORKER_ALIGN_TO_UPSTREAM is set, the cycles start WORKER_UPSTREAM_DELAY
+# seconds after the timestamp of the nodes.json (modulo the interval), so
+# every refresh upstream is picked up as soon as possible.
+WORKER_INTERVAL = 60
+WORKER_ALIGN_TO_UPSTREAM = False
+WORKER_UPSTREAM_DELAY = 5
+# seconds per phase of a worker cycle. The download is aborted after its
+# deadline, all other phases are only logged, if they take longer.
+WORKER_PHASE_DEADLINES = {
+    'load': 5,
+    'fetch': 20,
+    'sync': 10,
+    'check': 10,
+    'availability': 5,
+}
+# With WORKER_SHARDS > 1, several worker processes share the nodes. Each
+# node belongs to one shard (see shard_of()) and every shard is leased to one
+# worker for WORKER_LEASE_SECONDS, see WorkerLease.
+WORKER_SHARDS = 1
+WORKER_LEASE_SECONDS = 180
+MAIL_SENDER_CONNECTIONS = 2
+MAIL_MAX_ATTEMPTS = 8
+# seconds, doubled on every failed attempt
+MAIL_RETRY_BACKOFF = 60
+MAIL_RETRY_BACKOFF_MAX = 3600
+# Notification mails are held back this many seconds, so all mails to a user
+# within this window are sent as one digest. Mails from the same worker cycle
+# are always combined.
+MAIL_DIGEST_WINDOW = 0
+# Resolved alarms are kept this many days, older ones are folded into
+# AlarmRollups by retention.py.
+ALARM_RETENTION_DAYS = 90
+# Days of the availability history, which are kept by retention.py.
+AVAILABILITY_RETENTION_DAYS = 366
+
 from config import *
+from nodes_json import NodesJSONSource, NodesSnapshot, open_snapshot, parse_time
 
-SQLITE_URI = 'sqlite:///data.db'
 NODE_OFFLINE_TIMEOUT = datetime.timedelta(hours=1)
-DB_VERSION = 3
+# A node counts as up in the availability history, if it has been seen
+# within this time.
+AVAILABILITY_TIMEOUT = datetime.timedelta(minutes=5)
+ALARMS_PER_PAGE = 50
+# If the nodes.json has not been updated for this long, the state of the nodes
+# is unknown.
+NODE_UNKNOWN_TIMEOUT = datetime.timedelta(minutes=5)
+# NodeChange entries are kept this long. If the worker has not refreshed its
+# nodes for half of this time, it reloads all of them.
+NODE_CHANGES_RETENTION = datetime.timedelta(days=1)
+# NodeEvent entries are kept this long. Browsers, which reconnect later,
+# miss the older events and have to reload the page.
+NODE_EVENTS_RETENTION = datetime.timedelta(hours=1)
+DB_VERSION = 12
 
 Base = declarative_base()
 
@@ -43,6 +101,8 @@ class User(Base):
     email_confirmed = Column(Boolean, default=False)
     email_token = Column(String(64), default=lambda: secrets.token_urlsafe(64))
     created_at = Column(DateTime, default=func.now())
+    # preferred language for mails, e.g. 'de'
+    language = Column(String(8), default=None)
     subscriptions = relationship("Subscription", back_populates="user")
 
     def __repr__(self):
@@ -63,25 +123,32 @@ class User(Base):
 
         return tokens_match
 
-    def get_mail_template(self, name):
-        flask_locale = flask_get_locale()
-        if flask_locale:
-            language = flask_locale.language
-        else:
+    def get_mail_template(self, name, language=None):
+        """ Returns the mail template in the preferred language of the user.
+        Inside of a request the locale of the request is used, if the user
+        has not stored a preferred language yet. """
+
+        if language is None:
+            language = self.language
+
+        # Without flask loaded, there can not be a request either. This
+        # keeps flask out of the worker and the mail sender.
+        flask = sys.modules.get('flask')
+        if language is None and flask is not None and flask.has_request_context():
+            from flask_babel import get_locale
+            flask_locale = get_locale()
+            if flask_locale:
+                language = flask_locale.language
+
+        import mails
+        templates = mails.get_mail_templates()
+
+        if language not in templates:
             language = 'en'
 
-        t = gettext.translation('messages', localedir='translations', languages=[language])
-
-        if name == 'confirm':
-            return {"subject": t.gettext("mail:confirm:subject"),
-                    "message": t.gettext("mail:confirm:message")}
-        elif name == 'alarm':
-            return {"subject": t.gettext("mail:alarm:subject"),
-                    "message": t.gettext("mail:alarm:message")}
-        elif name == 'resolved':
-            return {"subject": t.gettext("mail:resolved:subject"),
-                    "message": t.gettext("mail:resolved:message")}
-        else:
+        try:
+            return templates[language][name]
+        except KeyError:
             raise Exception(f'No mail template named {name} found!')
 
     def send_confirm_mail(self, url):
@@ -90,99 +157,283 @@ class User(Base):
 
         self.send_mail(mail_template, url=url)
 
+    def build_mail(self, mail_template, in_reply_to = None, msgid = None, **kwargs):
+        """ Renders a mail to this user, see mails.build_message(). """
+
+        import mails
+        return mails.build_message(self.email, mail_template, in_reply_to, msgid, **kwargs)
+
     def send_mail(self, mail_template, in_reply_to = None, **kwargs):
-        msgid = make_msgid()
-
-        subject = mail_template['subject'].format(**kwargs)
-        message = mail_template['message'].format(**kwargs)
-
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = str(Header(subject, 'utf-8'))
-        msg['From'] = str(Header(SMTP_FROM, 'utf-8'))
-        msg['To'] = str(Header(self.email, 'utf-8'))
-        msg['Message-ID'] = msgid
-        msg['Reply-To'] = SMTP_REPLY_TO_EMAIL
-        msg['Date'] = datetime.datetime.now(pytz.utc).strftime("%a, %e %b %Y %T %z")
-
-        if in_reply_to:
-            msg['In-Reply-To'] = in_reply_to
-            msg['References'] = in_reply_to
-
-        # add message
-        charset = Charset('utf-8')
-        # QP = quoted printable; this is better readable instead of base64, when
-        # the mail is read in plaintext!
-        charset.body_encoding = QP
-        message_part = MIMEText(message.encode('utf-8'), 'plain', charset)
-        msg.attach(message_part)
-
-        if DEBUG:
-            with open("/tmp/keepitup_mails.log", "a") as f:
-                f.write(msg.as_string() + "\n")
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.ehlo()
-                if SMTP_USE_STARTTLS:
-                    context = ssl.create_default_context()
-                    server.starttls(context=context)
-                if SMTP_USER:
-                    server.login(SMTP_USER, SMTP_PASS)
+        msg = self.build_mail(mail_template, in_reply_to, **kwargs)
 
-                server.sendmail(SMTP_FROM, self.email, msg.as_string())
+        import mails
+        with mails.SMTPConnection() as conn:
+            conn.send(msg, self.email)
 
-        return msgid
+        return msg['Message-ID']
 
     @property
     def subscribed_nodes(self):
         return [subscription.node for subscription in self.subscriptions]
 
 
-class NodesJSONCache:
+class NodeIndex:
+    """ Base class for containers of nodes. The nodes are indexed by their
+    nodeid, so lookups do not need to scan the whole list. The index is
+    rebuilt whenever self.nodes is assigned, so the list should always be
+    replaced instead of being modified in place. """
 
     def __init__(self):
         self.nodes = []
 
-    def update(self, nodeset=None):
-        res = requests.get(NODES_JSON_URL)
+    @property
+    def nodes(self):
+        return self._nodes
 
-        if not res.ok:
-            print("warning: NodesJSONCache could not download " + NODES_JSON_URL + "!", file=sys.stderr)
-            return
+    @nodes.setter
+    def nodes(self, nodes):
+        self._nodes = nodes
+        self._by_nodeid = {node.nodeid: node for node in nodes}
+
+    def find_by_nodeid(self, nodeid):
+        return self._by_nodeid.get(nodeid)
+
+    def find_by_nodeids(self, nodeids):
+        """ Looks up many nodes at once. Returns a dict from nodeid to node,
+        which only contains the nodeids that have been found. """
+
+        by_nodeid = self._by_nodeid
+        return {nodeid: by_nodeid[nodeid] for nodeid in nodeids if nodeid in by_nodeid}
+
+
+class NodesJSONCache(NodeIndex):
+
+    def __init__(self, urls=None):
+        """ urls is a single url or a list of urls of nodes.json files.
+        Defaults to NODES_JSON_URL. """
+
+        urls = urls or NODES_JSON_URL
+        if isinstance(urls, str):
+            urls = [urls]
+
+        self.nodes = []
+        self.sources = [NodesJSONSource(url) for url in urls]
+        self._filter_nodeids = None
+        self._pool = None
+        # result of the last update() per url: 'modified', 'unchanged' or
+        # 'failed'
+        self.results = {}
+
+    @property
+    def url(self):
+        return ", ".join(source.url for source in self.sources)
+
+    @property
+    def timestamp(self):
+        """ The newest upstream timestamp of all sources. """
+
+        timestamps = [parse_time(source.timestamp) for source in self.sources if source.timestamp]
+        return max(timestamps).isoformat() if timestamps else None
+
+    @property
+    def size(self):
+        """ bytes of the last complete downloads, decoded """
+        return sum(source.size or 0 for source in self.sources)
+
+    @property
+    def transfer_size(self):
+        """ bytes of the last complete downloads, as transferred """
+        return sum(source.transfer_size or 0 for source in self.sources)
+
+    def _download_all(self, filter_nodeids, keep_all, deadline):
+        """ Downloads all sources concurrently. Returns (source, download or
+        exception) for every source. A source, which has not finished at its
+        deadline, is given up. """
+
+        import concurrent.futures
+
+        # A single source is downloaded in the pool as well, so a hanging
+        # download is given up in time.
+        if self._pool is None:
+            # Abandoned downloads might still occupy a thread for a while.
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * len(self.sources))
+
+        futures = [(source, self._pool.submit(source.download, filter_nodeids, keep_all, deadline))
+                   for source in self.sources]
+        # The deadline is enforced by every download itself, this is only
+        # the last resort, if one hangs somewhere else.
+        concurrent.futures.wait([future for _, future in futures], timeout=deadline + 1 if deadline is not None else None)
+
+        results = []
+        for source, future in futures:
+            if not future.done():
+                results += [(source, TimeoutError())]
+                continue
+            try:
+                results += [(source, future.result())]
+            except Exception as e:
+                results += [(source, e)]
+
+        return results
+
+    def update(self, nodeset=None, filter_nodeids=None, snapshot_path=None, deadline=None):
+        """ Downloads the nodes.json files of all sources concurrently and
+        parses them node by node, so that the memory usage stays flat even
+        for huge meshes. If filter_nodeids is given, all other nodes are
+        dropped before any objects are built.
+
+        The nodes of all sources are merged by their nodeid. The newest
+        lastseen wins, and last_updated_at is the newest timestamp of all
+        sources, which contain the node. So the nodes of a source, which is
+        down, become unknown after a while, see NODE_UNKNOWN_TIMEOUT.
+
+        If snapshot_path is given, all nodes (also the filtered ones) are
+        published there as NodesSnapshot for the webserver processes.
+
+        If deadline is given, the download of every source (including the
+        parsing) is aborted after this many seconds. A source, which fails,
+        does not hold up the others; its last nodes are used instead.
+
+        If the same cache is updated repeatedly, the downloads are
+        conditional. Returns True, if self.nodes has been replaced, and
+        False if no nodes.json was modified since the last update (or none
+        could be loaded). In this case self.nodes is kept as it is. """
+
+        # The last result can only be reused, if it has been filtered the
+        # same way. Nodes from a nodeset are never reused, as they belong to
+        # another session.
+        if nodeset or filter_nodeids != self._filter_nodeids:
+            for source in self.sources:
+                source.reset()
+        self._filter_nodeids = filter_nodeids
+
+        keep_all = snapshot_path is not None
+        if keep_all:
+            # all nodes are needed for the snapshot
+            for source in self.sources:
+                if source.spool is None:
+                    source.reset()
+
+        modified = False
+        self.results = {}
+
+        # requests is only loaded for downloads, see nodes_json.get_http_session()
+        import requests
+
+        for source, download in self._download_all(filter_nodeids, keep_all, deadline):
+            result = 'failed'
+
+            if isinstance(download, TimeoutError):
+                print("warning: NodesJSONCache aborted the download of " + source.url + " after " + str(deadline) + " s!", file=sys.stderr)
+            elif isinstance(download, requests.RequestException):
+                print("warning: NodesJSONCache could not download " + source.url + "!", file=sys.stderr)
+            elif isinstance(download, (KeyError, TypeError, ValueError)):
+                print("warning: NodesJSONCache detected wrong format for " + source.url + "!", file=sys.stderr)
+            elif isinstance(download, Exception):
+                print("warning: NodesJSONCache could not load " + source.url + ": " + repr(download), file=sys.stderr)
+            elif download is None or download.records is None:
+                if download is not None:
+                    source.commit(download)
+                result = 'unchanged'
+            else:
+                source.commit(download)
+                result = 'modified'
+                modified = True
+
+            self.results[source.url] = result
+
+        if not modified:
+            return False
+
+        if keep_all:
+            # The nodes are read back from the spool files of the sources,
+            # so they are only in memory while the snapshot is written.
+            all_records = (record for source in self.sources for record in source.all_records())
+            try:
+                NodesSnapshot.publish(snapshot_path, self.timestamp, all_records)
+            except OSError as e:
+                print("warning: NodesJSONCache could not publish snapshot " + snapshot_path + ": " + str(e), file=sys.stderr)
+
+        # nodeid: [hostname, last_seen_at, last_updated_at]
+        merged = {}
+        for source in self.sources:
+            if source.timestamp is None:
+                continue
+            updated_at = parse_time(source.timestamp)
+
+            for nodeid, hostname, last_seen_at in source.records:
+                m = merged.get(nodeid)
+                if m is None:
+                    merged[nodeid] = [hostname, last_seen_at, updated_at]
+                    continue
+
+                if last_seen_at is not None and (m[1] is None or last_seen_at > m[1]):
+                    m[0], m[1] = hostname, last_seen_at
+                m[2] = max(m[2], updated_at)
 
         nodes = []
-        try:
-            json = res.json()
-            for node in json['nodes']:
-                nodeinfo = node['nodeinfo']
-
-                if nodeset:
-                    db_node = nodeset.find_by_nodeid(nodeinfo['node_id'])
-                    if db_node:
-                        nodes += [db_node]
-                        continue
-
-                n = Node(nodeinfo['hostname'], nodeinfo['node_id'])
-                if 'lastseen' in node:
-                    n.last_seen_at = parse_time(node['lastseen'])
-                n.last_updated_at = parse_time(json['timestamp'])
-                nodes += [n]
-        except KeyError:
-            print("warning: NodesJSONCache detected wrong format for " + NODES_JSON_URL + "!", file=sys.stderr)
-            return
+        for nodeid, (hostname, last_seen_at, last_updated_at) in merged.items():
+            if nodeset:
+                db_node = nodeset.find_by_nodeid(nodeid)
+                if db_node:
+                    nodes += [db_node]
+                    continue
+
+            n = Node(hostname, nodeid)
+            n.last_seen_at = last_seen_at
+            n.last_updated_at = last_updated_at
+            nodes += [n]
 
         self.nodes = nodes
+        return True
 
-    def find_by_nodeid(self, nodeid):
-        for node in self.nodes:
-            if node.nodeid == nodeid:
-                return node
+    def load_snapshot(self, snapshot_path, nodeset=None, filter_nodeids=None):
+        """ Same as update(), but reads the snapshot published by the worker
+        instead of downloading the nodes.json. Returns False, if there is no
+        snapshot (yet). """
 
-    def update_db_node(self, node):
+        snapshot = open_snapshot(snapshot_path)
+        if snapshot is None:
+            return False
+
+        if filter_nodeids is not None:
+            records = filter(None, (snapshot.find(nodeid) for nodeid in filter_nodeids))
+        else:
+            records = snapshot
+
+        nodes = []
+        for nodeid, hostname, lastseen in records:
+            if nodeset:
+                db_node = nodeset.find_by_nodeid(nodeid)
+                if db_node:
+                    nodes += [db_node]
+                    continue
+
+            n = Node(hostname, nodeid)
+            if lastseen is not None:
+                n.last_seen_at = parse_time(lastseen)
+            nodes += [n]
+
+        self._set_nodes(nodes, snapshot.timestamp)
+        return True
+
+    def _set_nodes(self, nodes, timestamp):
+        # The timestamp is parsed only once, and it might not be known
+        # before the end of the file.
+        last_updated_at = parse_time(timestamp)
+        for n in nodes:
+            if not n.is_in_db:
+                n.last_updated_at = last_updated_at
+
+        self.nodes = nodes
+
+    def update_db_node(self, node, other=None):
         """ Update a node from the nodes.json. This makes only sense, if
         nodes_json_cache.update() has been called with nodeset=None.
         Otherwise the nodes_json_cache contains the nodes from nodeset. """
 
-        other = self.find_by_nodeid(node.nodeid)
+        if other is None:
+            other = self.find_by_nodeid(node.nodeid)
 
         # node does not exist in nodes.json anymore, so we can not
         # update it.
@@ -193,41 +444,477 @@ class NodesJSONCache:
         node.last_seen_at = other.last_seen_at
         node.last_updated_at = other.last_updated_at
 
+    def update_db_nodes(self, nodes):
+        """ Same as update_db_node(), but for many nodes at once. """
+
+        others = self.find_by_nodeids(node.nodeid for node in nodes)
+
+        for node in nodes:
+            other = others.get(node.nodeid)
+            if other:
+                self.update_db_node(node, other)
+
 
 class Subscription(Base):
     __tablename__ = 'subscriptions'
 
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, nullable=False)
-    node_id = Column(Integer, ForeignKey('nodes.id'), primary_key=True, nullable=False)
+    node_id = Column(Integer, ForeignKey('nodes.id'), primary_key=True, nullable=False, index=True)
     send_notifications = Column(Boolean, default=True)
     user = relationship("User", back_populates="subscriptions")
     node = relationship("Node", back_populates="subscriptions")
 
 
-class NodeSet:
+class OutboxMail(Base):
+    """ A notification mail, which still has to be sent (or has been sent).
+    The worker only queues these, while mail_sender.py renders and sends
+    them. """
+
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_alarm_id', 'alarm_id'),
+        # only the mails, which still have to be sent
+        Index('ix_outbox_pending', 'next_attempt_at', sqlite_where=text('sent_at IS NULL')),
+    )
+
+    id = Column(Integer, Sequence('outbox_id_seq'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship("User")
+    alarm_id = Column(Integer, ForeignKey('alarms.id'), nullable=False)
+    alarm = relationship("Alarm")
+    # 'alarm' or 'resolved'
+    kind = Column(String(16), nullable=False)
+    created_at = Column(DateTime, default=func.now())
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=func.now())
+    sent_at = Column(DateTime, default=None)
+    msgid = Column(String(995), default=None)
+    last_error = Column(String(255), default=None)
 
-    def __init__(self):
-        self.nodes = []
+    @classmethod
+    def due(cls, session, now, limit, user_ids=None):
+        """ Returns the mails, which are due. If user_ids is given, all due
+        mails of these users are returned (without limit), along with their
+        mails, which are still held back for a digest (see
+        MAIL_DIGEST_WINDOW). So a digest also takes the mails of the later
+        worker cycles within the window. """
+
+        q = session.query(OutboxMail).\
+            filter(OutboxMail.sent_at == None).\
+            filter(OutboxMail.attempts < MAIL_MAX_ATTEMPTS).\
+            order_by(OutboxMail.next_attempt_at, OutboxMail.id)
+
+        if user_ids is not None:
+            return q.filter(OutboxMail.user_id.in_(user_ids)).\
+                filter((OutboxMail.next_attempt_at <= now) | (OutboxMail.attempts == 0)).all()
+        return q.filter(OutboxMail.next_attempt_at <= now).limit(limit).all()
+
+    def find_alarm_mail(self, session):
+        """ Returns the alarm mail to the same user, which a resolved mail
+        replies to. """
+
+        return session.query(OutboxMail).\
+            filter(OutboxMail.alarm_id == self.alarm_id).\
+            filter(OutboxMail.user_id == self.user_id).\
+            filter(OutboxMail.kind == 'alarm').\
+            order_by(OutboxMail.id.desc()).\
+            limit(1).one_or_none()
+
+    def render(self, session):
+        """ Builds the message. Returns None, if the mail has to wait for the
+        alarm mail it replies to. """
+
+        alarm = self.alarm
+        node = alarm.node
+        url = APP_URL + 'node/' + node.nodeid
+        in_reply_to = None
+
+        if self.kind == 'resolved':
+            alarm_mail = self.find_alarm_mail(session)
+            if alarm_mail is not None:
+                if alarm_mail.sent_at is None and alarm_mail.attempts < MAIL_MAX_ATTEMPTS:
+                    return None
+                in_reply_to = alarm_mail.msgid
+            else:
+                in_reply_to = alarm.alarm_mail_msgid
+
+        if self.msgid is None:
+            # The msgid is kept for retries, so replies stay consistent.
+            from email.utils import make_msgid
+            self.msgid = make_msgid()
+
+        mail_template = self.user.get_mail_template(self.kind)
+        return self.user.build_mail(mail_template, in_reply_to=in_reply_to,
+                                    msgid=self.msgid, node=node, url=url)
+
+    @classmethod
+    def render_digest(cls, mails):
+        """ Builds a single message for several mails to the same user,
+        which are about different nodes. The digest replies to nothing, and
+        all mails get its msgid, so later resolved mails reply to it. """
+
+        from email.utils import make_msgid
+
+        user = mails[0].user
+        # The msgid is kept for retries, see render().
+        msgid = next((mail.msgid for mail in mails if mail.msgid is not None), None) or make_msgid()
+        mail_template = user.get_mail_template('digest')
+
+        lines = []
+        for mail in mails:
+            mail.msgid = msgid
+            node = mail.alarm.node
+            lines += [mail_template[mail.kind].format(node=node, url=APP_URL + 'node/' + node.nodeid)]
+
+        alarms = sum(1 for mail in mails if mail.kind == 'alarm')
+        return user.build_mail(mail_template, msgid=msgid, alarms=alarms, resolved=len(mails) - alarms,
+                               lines='\n'.join(lines), url=APP_URL)
+
+    def mark_sent(self, now):
+        self.sent_at = now
+        self.last_error = None
+
+        if self.kind == 'alarm':
+            self.alarm.alarm_mail_msgid = self.msgid
+
+    def drop(self, error):
+        """ Gives up on the mail without any further attempts. """
+
+        self.attempts = MAIL_MAX_ATTEMPTS
+        self.last_error = str(error)[:255]
+
+    def mark_failed(self, now, error):
+        self.attempts += 1
+        self.last_error = str(error)[:255]
+        backoff = min(MAIL_RETRY_BACKOFF * 2 ** (self.attempts - 1), MAIL_RETRY_BACKOFF_MAX)
+        self.next_attempt_at = now + datetime.timedelta(seconds=backoff)
+
+
+def shard_of(nodeid, shards):
+    """ Returns the shard of a node, if the nodes are split into the given
+    number of shards. """
+
+    return zlib.crc32(nodeid.encode('utf-8')) % shards
+
+
+class NodeSet(NodeIndex):
+
+    def __init__(self, shards=None, shard_count=1):
+        """ A worker, which only owns some of the shards (see WorkerLease),
+        passes them here. Then, only the nodes of these shards are loaded. """
+
+        super().__init__()
+        self.shards = shards
+        self.shard_count = shard_count
+
+    def _in_shards(self, nodes):
+        if self.shards is None:
+            return nodes
+        return [n for n in nodes if shard_of(n.nodeid, self.shard_count) in self.shards]
 
     def update_from_db(self, session, filter_user=None):
         # force reload from db
         session.expire_all()
 
+        # Changes after this point are applied by refresh(). If one of them
+        # is already part of the nodes below, it is applied once more.
+        self.watermark = NodeChange.latest_id(session)
+        self.refreshed_at = datetime.datetime.now()
+
         q = session.query(Node)
         if filter_user is not None:
             # TODO: update here
             q = q.filter(Node.user == filter_user)
 
-        self.nodes = q.all()
+        self.nodes = self._in_shards(q.all())
+
+    def refresh(self, session):
+        """ Applies the nodes, which have been inserted or deleted (by the
+        webserver) since the last update_from_db() or refresh(). All other
+        nodes are kept as they are, so this only works, if nobody else
+        changes the nodes and the session does not expire them on commit.
+        Returns True, if anything has changed. """
+
+        now = datetime.datetime.now()
+        if now - self.refreshed_at > NODE_CHANGES_RETENTION / 2:
+            # the log might have been pruned in the meantime
+            self.update_from_db(session)
+            return True
+        self.refreshed_at = now
+
+        changes = session.execute(select(NodeChange.id, NodeChange.node_id).
+                                  where(NodeChange.id > self.watermark).
+                                  order_by(NodeChange.id)).all()
+        if not changes:
+            return False
+
+        self.watermark = changes[-1].id
+        changed_ids = {change.node_id for change in changes}
+
+        nodes = [n for n in self.nodes if n.id not in changed_ids]
+        for n in self.nodes:
+            if n.id in changed_ids:
+                session.expunge(n)
+
+        # Deleted nodes are not found anymore.
+        nodes += self._in_shards(session.query(Node).filter(Node.id.in_(changed_ids)).populate_existing().all())
+        self.nodes = nodes
+
+        NodeChange.prune(session, now - NODE_CHANGES_RETENTION)
+        session.commit()
+        return True
+
+    def sync(self, session, nodes_json_cache):
+        """ Does the same as nodes_json_cache.update_db_nodes() and a
+        commit, but only the nodes, whose name or last_seen_at have actually
+        changed, are written. Returns the number of written nodes.
+
+        last_updated_at is the timestamp of the nodes.json, so it changes
+        for all nodes, whenever a source is updated. It is written with a
+        single statement per source instead. """
+
+        # The db does not store timezones, see NodeSet.check().
+        def naive(t):
+            return t.replace(tzinfo=None) if t is not None else None
+
+        others = nodes_json_cache.find_by_nodeids(node.nodeid for node in self.nodes)
+        rows = []
+        renamed = False
 
-    def find_by_nodeid(self, nodeid):
         for node in self.nodes:
-            if node.nodeid == nodeid:
-                return node
+            other = others.get(node.nodeid)
+            if not other:
+                continue
+
+            values = {'name': other.name, 'last_seen_at': naive(other.last_seen_at)}
+
+            if all(getattr(node, attr) == value for attr, value in values.items()):
+                continue
+
+            renamed = renamed or node.name != other.name
+            rows += [(node, values)]
+
+        if renamed:
+            DataVersion.bump(session)
+
+        nodes_table = Node.__table__
+        if rows:
+            stmt = nodes_table.update().\
+                where(nodes_table.c.id == bindparam('_id')).\
+                values(name=bindparam('_name'), last_seen_at=bindparam('_last_seen_at'))
+            session.execute(stmt, [{'_id': node.id,
+                                    '_name': values['name'],
+                                    '_last_seen_at': values['last_seen_at']} for node, values in rows])
+
+        # A node, which is in several nodes.json, gets the newest timestamp.
+        for source in nodes_json_cache.sources:
+            if source.timestamp is None:
+                continue
+
+            updated_at = naive(parse_time(source.timestamp))
+            nodeids = {record[0] for record in source.records}
+            stale = [node for node in self.nodes if node.nodeid in nodeids
+                     and (node.last_updated_at is None or node.last_updated_at < updated_at)]
+            if not stale:
+                continue
+
+            # the ids are inlined, as there might be more than sqlite allows
+            # as parameters
+            stmt = nodes_table.update().\
+                where(nodes_table.c.id.in_(bindparam('_ids', expanding=True, literal_execute=True))).\
+                values(last_updated_at=updated_at)
+            session.execute(stmt, {'_ids': [node.id for node in stale]})
+
+            for node in stale:
+                set_committed_value(node, 'last_updated_at', updated_at)
+
+        # see NodeSet.check()
+        for node, values in rows:
+            for attr, value in values.items():
+                set_committed_value(node, attr, value)
+
+        session.commit()
+        return len(rows)
+
+    def check(self, session):
+        """ Checks all nodes for state changes. The nodes are evaluated at
+        once and all changes are written in a single transaction. Returns
+        the list of alarms, which have been created or resolved. The
+        notification mails are queued in the same transaction, their number
+        is stored in self.queued_mails. Every change is also logged as a
+        NodeEvent for the live updates of the web pages. """
+
+        import numpy as np
+
+        self.queued_mails = 0
+        nodes = self.nodes
+        if not nodes:
+            return []
+
+        now = np.datetime64(datetime.datetime.now(), 'us')
+
+        def datetimes(attr):
+            # The db does not store timezones, so they are dropped here as
+            # well, to get the same result as after a reload from the db.
+            return np.array([getattr(n, attr).replace(tzinfo=None) if getattr(n, attr) is not None else None
+                             for n in nodes], dtype='datetime64[us]')
+
+        last_seen_at = datetimes('last_seen_at')
+        last_updated_at = datetimes('last_updated_at')
+
+        old_unknown = np.array([bool(n.is_state_unknown) for n in nodes])
+        old_states = np.array([n.state for n in nodes], dtype=object)
+
+        # The state is unknown, if the node has never been seen, or if its
+        # nodes.json has not been updated for NODE_UNKNOWN_TIMEOUT.
+        unknown = np.isnat(last_updated_at) | np.isnat(last_seen_at) \
+            | (now - last_updated_at > np.timedelta64(NODE_UNKNOWN_TIMEOUT))
+
+        # the state of unknown nodes is kept
+        new_states = np.where(now - last_seen_at > np.timedelta64(NODE_OFFLINE_TIMEOUT), 'problem', 'ok').astype(object)
+        new_states[unknown] = old_states[unknown]
+
+        changed = np.flatnonzero((unknown != old_unknown) | (new_states != old_states))
+
+        state_changed = set(np.flatnonzero(new_states != old_states))
+        lost = set()
+
+        if len(changed) > 0:
+            DataVersion.bump(session)
+
+            # Nodes, which only became unknown or known again, are written at
+            # once. No alarm depends on this.
+            nodes_table = Node.__table__
+            stmt = nodes_table.update().\
+                where(nodes_table.c.id == bindparam('_id')).\
+                values(is_state_unknown=bindparam('_unknown'))
+            rows = [{'_id': nodes[i].id, '_unknown': bool(unknown[i])}
+                    for i in changed if i not in state_changed]
+            if rows:
+                session.execute(stmt, rows)
+
+            # A state change creates or resolves an alarm, so it is only
+            # written, if the db still has the old state. If another worker
+            # has already switched the node (e.g. while its shard moved, see
+            # WorkerLease), the node is skipped here and no second alarm is
+            # created.
+            stmt = nodes_table.update().\
+                where(nodes_table.c.id == bindparam('_id')).\
+                where(nodes_table.c.state.is_(bindparam('_old_state'))).\
+                values(is_state_unknown=bindparam('_unknown'), state=bindparam('_state'))
+            for i in sorted(state_changed):
+                res = session.execute(stmt, {'_id': nodes[i].id,
+                                             '_old_state': old_states[i],
+                                             '_unknown': bool(unknown[i]),
+                                             '_state': new_states[i]})
+                if res.rowcount == 0:
+                    lost.add(i)
+
+            # The orm does not know about the updates above, so the new
+            # values are set as if they had been loaded from the db. Lost
+            # nodes are loaded again on their next use.
+            for i in changed:
+                if i in lost:
+                    session.expire(nodes[i], ['state', 'is_state_unknown'])
+                    continue
+                set_committed_value(nodes[i], 'is_state_unknown', bool(unknown[i]))
+                set_committed_value(nodes[i], 'state', new_states[i])
+
+            changed = [i for i in changed if i not in lost]
+
+        # A node, which goes offline, raises an alarm, which is resolved,
+        # when it is back online.
+        alarms = []
+        resolving = []
+        for i in sorted(state_changed - lost):
+            node = nodes[i]
+            old_state, new_state = old_states[i], new_states[i]
+
+            if old_state == 'ok' and new_state == 'problem':
+                alarm = Alarm(node=node)
+                alarm.alarm_at = node.last_seen_at
+                alarms += [alarm]
+
+            if old_state == 'new' and new_state == 'problem':
+                alarm = Alarm(node=node)
+                alarm.alarm_at = now.astype(datetime.datetime)
+                alarms += [alarm]
+
+            if old_state == 'problem' and new_state == 'ok':
+                resolving += [node]
+
+        session.add_all(alarms)
+
+        if resolving:
+            latest_ids = select(func.max(Alarm.id)).\
+                filter(Alarm.node_id.in_([node.id for node in resolving])).\
+                group_by(Alarm.node_id)
+            latest_alarms = {alarm.node_id: alarm for alarm in
+                             session.query(Alarm).filter(Alarm.id.in_(latest_ids))}
+
+            for node in resolving:
+                alarm = latest_alarms.get(node.id)
+                if alarm:
+                    alarm.resolved_at = node.last_seen_at
+                    alarms += [alarm]
+
+        # The mails are only queued here and sent by mail_sender.py.
+        self.queued_mails = sum(alarm.queue_notification_mails(session) for alarm in alarms)
+
+        if len(changed) > 0:
+            # the new alarms need their ids for the events
+            session.flush()
+            alarms_by_node = {alarm.node_id: alarm for alarm in alarms}
+            NodeEvent.publish(session, [(nodes[i], alarms_by_node.get(nodes[i].id)) for i in changed])
+        NodeEvent.prune(session, now.astype(datetime.datetime) - NODE_EVENTS_RETENTION)
+
+        session.commit()
+
+        return alarms
+
+    def record_availability(self, store, now=None):
+        """ Records in the AvailabilityStore, which nodes are up right now.
+        Only the nodes of this NodeSet are recorded (with several workers
+        only the shards of this one), and nodes in unknown state (e.g.
+        missing in the nodes.json) are not observed in this minute at all,
+        so they count as missing data instead of downtime. """
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        known = [n for n in self.nodes if not n.is_state_unknown]
+        if not known:
+            return
+
+        up = [n.nodeid for n in known
+              if n.last_seen_at is not None
+              and now - n.last_seen_at.replace(tzinfo=None) <= AVAILABILITY_TIMEOUT]
+
+        store.record(now, [n.nodeid for n in known], up)
+
+def format_duration(seconds):
+    if seconds > 24*60*60:
+        return "%d days" % (seconds / 24 / 60 / 60)
+
+    if seconds > 60*60:
+        return "%d hrs" % (seconds / 60 / 60)
+
+    if seconds > 60:
+        return "%d min" % (seconds / 60)
+
+    return "%d s" % seconds
 
 
 class Alarm(Base):
     __tablename__ = 'alarms'
+    __table_args__ = (
+        # alarm history and latest alarm of a node
+        Index('ix_alarms_node_id_id', 'node_id', 'id'),
+        # open alarm of a node
+        Index('ix_alarms_node_id_resolved_at', 'node_id', 'resolved_at'),
+        # old alarms for AlarmRollup.fold()
+        Index('ix_alarms_resolved_at', 'resolved_at'),
+    )
 
     id = Column(Integer, Sequence('alarm_id_seq'), primary_key=True)
     node_id = Column(Integer, ForeignKey('nodes.id'))
@@ -244,41 +931,37 @@ class Alarm(Base):
 
     @property
     def duration_str(self):
-        if not self.is_resolved:
+        # is_resolved is only updated on a reload, resolved_at right away
+        if self.resolved_at is None:
             return "ongoing"
 
-        delta = self.resolved_at - self.alarm_at
-
-        if delta.total_seconds() > 24*60*60:
-            return "%d days" % (delta.total_seconds() / 24 / 60 / 60)
-
-        if delta.total_seconds() > 60*60:
-            return "%d hrs" % (delta.total_seconds() / 60 / 60)
+        return format_duration((self.resolved_at - self.alarm_at).total_seconds())
 
-        if delta.total_seconds() > 60:
-            return "%d min" % (delta.total_seconds() / 60)
+    def queue_notification_mails(self, session):
+        """ Queues the notification mails for all subscribers in the outbox.
+        The caller has to commit the session. Returns the number of queued
+        mails. """
 
-        return "%d s" % delta.total_seconds()
+        kind = 'resolved' if self.resolved_at is not None else 'alarm'
+        queued = 0
+        # see MAIL_DIGEST_WINDOW
+        next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=MAIL_DIGEST_WINDOW)
 
-    def send_notification_mails(self, session):
-        node = self.node
-        url = APP_URL + 'node/' + self.node.nodeid
+        # The subscriptions are changed by the webserver, so they are always
+        # read from the db, even if they have been loaded before.
+        subscriptions = session.query(Subscription).\
+            filter(Subscription.node_id == self.node.id).\
+            populate_existing().all()
 
-        for subscription in node.subscriptions:
+        for subscription in subscriptions:
             if not subscription.send_notifications:
                 continue
 
-            user = subscription.user
+            session.add(OutboxMail(user=subscription.user, alarm=self, kind=kind,
+                                   next_attempt_at=next_attempt_at))
+            queued += 1
 
-            if self.is_resolved:
-                mail_template = user.get_mail_template("resolved")
-                user.send_mail(mail_template, in_reply_to=self.alarm_mail_msgid, node=node, url=url)
-            else:
-                mail_template = user.get_mail_template("alarm")
-                self.alarm_mail_msgid = user.send_mail(mail_template, node=node, url=url)
-
-                session.add(self)
-                session.commit()
+        return queued
 
 
 class Node(Base):
@@ -287,7 +970,7 @@ class Node(Base):
     id = Column(Integer, Sequence('node_id_seq'), primary_key=True)
     name = Column(String(64))
     nodeid = Column(String(32), unique=True)
-    state = Column(String(16))
+    state = Column(String(16), index=True)
     # The state 'unknown' is stored in the separate column is_state_unknown, so
     # we can recover the old state as soon as is_state_unknown becomes False
     # again.
@@ -304,69 +987,71 @@ class Node(Base):
         self.state = "new"
         self.is_state_unknown = True
 
-    def _switch_state(self, session):
-        old_state = self.state
-
-        if datetime.datetime.now() - self.last_seen_at > NODE_OFFLINE_TIMEOUT:
-            new_state = 'problem'
-        else:
-            new_state = 'ok'
-
-        if new_state != old_state:
-            self.state = new_state
-            session.add(self)
-            session.commit()
+    def latest_alarm(self, session):
+        # The id is found in the index alone, the alarm itself is then
+        # loaded by its primary key (or taken from the session).
+        alarm_id = session.execute(select(Alarm.id).
+                                   where(Alarm.node_id == self.id).
+                                   order_by(Alarm.id.desc()).
+                                   limit(1)).scalar()
+        if alarm_id is None:
+            return None
+        return session.get(Alarm, alarm_id)
 
-        return old_state, new_state
+    def open_alarm(self, session):
+        """ Returns the alarm, which has not been resolved yet, if any. """
 
-    def _update_waiting(self, session):
-        """ This function calculates and updates the waiting status."""
+        alarm_id = session.execute(select(Alarm.id).
+                                   where(Alarm.node_id == self.id).
+                                   where(Alarm.resolved_at == None).
+                                   order_by(Alarm.id.desc()).
+                                   limit(1)).scalar()
+        if alarm_id is None:
+            return None
+        return session.get(Alarm, alarm_id)
 
-        self.is_state_unknown = ( \
-            self.last_updated_at is None \
-            or self.last_seen_at is None \
-            or datetime.datetime.now() - self.last_updated_at > datetime.timedelta(minutes=5) \
-        )
-        session.add(self)
-        session.commit()
+    def alarm_page(self, session, before=None, limit=ALARMS_PER_PAGE):
+        """ Returns one page of the alarm history, newest first. The page
+        starts after the alarm with the id before (keyset pagination). Also
+        returns the value of before for the next page, or None if this is
+        the last page. """
 
-    def check(self, session):
-        """ Checks for state changes. Returns an Alarm object, if an alarm
-        has just been created, or an alarm has just been resolved. This means
-        it only returns an Alarm object if a state change happened. """
+        q = session.query(Alarm).filter(Alarm.node_id == self.id)
+        if before is not None:
+            q = q.filter(Alarm.id < before)
 
-        self._update_waiting(session)
-        if self.is_state_unknown:
-            # switching state is only allowed when node is not waiting
-            return None
+        alarms = q.order_by(Alarm.id.desc()).limit(limit + 1).all()
 
-        old_state, new_state = self._switch_state(session)
-        alarm = None
+        if len(alarms) > limit:
+            return alarms[:limit], alarms[limit - 1].id
+        return alarms, None
 
-        if old_state == 'ok' and new_state == 'problem':
-            alarm = Alarm(node=self)
-            alarm.alarm_at = self.last_seen_at
+    @classmethod
+    def find_by_nodeid(cls, session, nodeid):
+        return session.query(Node).filter(Node.nodeid == nodeid).one_or_none()
 
-        if old_state == 'new' and new_state == 'problem':
-            alarm = Alarm(node=self)
-            alarm.alarm_at = datetime.datetime.now()
+    @classmethod
+    def status_rows(cls, session, nodeids=None, constitution=None):
+        """ Returns the status of the nodes with the given nodeids, or of all
+        nodes in the given constitution, together with their open alarm.
+        This is a single query (using the indexes on nodes.nodeid or
+        nodes.state and ix_alarms_node_id_resolved_at), which returns plain
+        rows instead of orm objects, so large results can be streamed. """
 
-        if old_state == 'problem' and new_state == 'ok':
-            alarm = self.latest_alarm(session)
-            alarm.resolved_at = self.last_seen_at
+        stmt = select(Node.nodeid, Node.name, Node.state, Node.is_state_unknown, Node.last_seen_at,
+                      Alarm.id.label('alarm_id'), Alarm.alarm_at).\
+            outerjoin(Alarm, (Alarm.node_id == Node.id) & (Alarm.resolved_at == None)).\
+            order_by(Node.nodeid)
 
-        if alarm:
-            session.add(alarm)
-            session.commit()
-            alarm.send_notification_mails(session)
+        if nodeids is not None:
+            stmt = stmt.where(Node.nodeid.in_(nodeids))
 
-        return alarm
+        if constitution == 'unknown':
+            stmt = stmt.where(Node.is_state_unknown == True)
+        elif constitution is not None:
+            stmt = stmt.where(Node.state == constitution).where(Node.is_state_unknown == False)
 
-    def latest_alarm(self, session):
-        return session.query(Alarm).\
-            filter(Alarm.node_id == self.id).\
-            order_by(Alarm.id.desc()).\
-            limit(1).one_or_none()
+        return session.execute(stmt)
 
     @property
     def subscribed_users(self):
@@ -377,6 +1062,18 @@ class Node(Base):
         # nodes in db have an id, others don't
         return bool(self.id)
 
+    def delete(self, session):
+        """ Deletes the node along with its alarms, their mails and its
+        AlarmRollups. Mails, which are still queued, could not be rendered
+        anymore without the node. The caller has to commit. """
+
+        alarm_ids = select(Alarm.id).where(Alarm.node_id == self.id)
+        session.execute(OutboxMail.__table__.delete().where(OutboxMail.alarm_id.in_(alarm_ids)))
+        session.execute(Alarm.__table__.delete().where(Alarm.node_id == self.id))
+        session.execute(AlarmRollup.__table__.delete().where(AlarmRollup.node_id == self.id))
+        session.expire(self, ['alarms'])
+        session.delete(self)
+
     def get_subscription_by_user(self, session, user):
         if user is None:
             return None
@@ -402,34 +1099,355 @@ class DBVersion(Base):
     def __init__(self):
         self.id = 1
 
+    # These work with a session as well as with a plain connection, as the
+    # migrations run on the latter.
+
     @classmethod
     def get(cls, session):
-        version_obj = session.query(DBVersion).one_or_none()
-        if not version_obj:
-            return 0
-        return version_obj.version
+        version = session.execute(select(DBVersion.version).where(DBVersion.id == 1)).scalar()
+        return version or 0
 
     @classmethod
     def set(cls, session, new_version):
-        version_obj = session.query(DBVersion).one_or_none()
-        if not version_obj:
-            version_obj = DBVersion()
-        version_obj.version = new_version
-        session.add(version_obj)
+        table = DBVersion.__table__
+        res = session.execute(table.update().where(table.c.id == 1).values(version=new_version))
+        if res.rowcount == 0:
+            session.execute(table.insert().values(id=1, version=new_version))
+
+
+class AlarmRollup(Base):
+    """ Number and total duration of the old alarms of a node per day (of
+    alarm_at). Resolved alarms older than ALARM_RETENTION_DAYS are folded
+    into these and deleted by retention.py. """
+
+    __tablename__ = 'alarm_rollups'
+
+    node_id = Column(Integer, ForeignKey('nodes.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    downtime_seconds = Column(Float, nullable=False, default=0)
+
+    @classmethod
+    def fold(cls, session, before, limit):
+        """ Folds up to limit alarms, which have been resolved before the
+        given time, into the rollups and deletes them along with their
+        mails. Alarms of deleted nodes (see Node.delete()) are deleted
+        without being folded. The caller has to commit. Returns the number
+        of deleted alarms. """
+
+        ids = session.execute(select(Alarm.id).
+                              where(Alarm.node_id == None).
+                              limit(limit)).scalars().all()
+        if len(ids) < limit:
+            ids += session.execute(select(Alarm.id).
+                                   where(Alarm.resolved_at < before).
+                                   where(Alarm.node_id != None).
+                                   order_by(Alarm.resolved_at).
+                                   limit(limit - len(ids))).scalars().all()
+        if not ids:
+            return 0
+
+        alarms = Alarm.__table__
+        rollups = AlarmRollup.__table__
+        day = func.date(alarms.c.alarm_at)
+        stmt = sqlite_insert(rollups).from_select(
+            ['node_id', 'day', 'count', 'downtime_seconds'],
+            select(alarms.c.node_id, day, func.count(),
+                   func.sum((func.julianday(alarms.c.resolved_at) - func.julianday(alarms.c.alarm_at)) * 86400)).
+            where(alarms.c.id.in_(ids)).
+            where(alarms.c.node_id != None).
+            where(alarms.c.resolved_at != None).
+            group_by(alarms.c.node_id, day))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['node_id', 'day'],
+            set_={'count': rollups.c.count + stmt.excluded.count,
+                  'downtime_seconds': rollups.c.downtime_seconds + stmt.excluded.downtime_seconds})
+        session.execute(stmt)
+
+        session.execute(OutboxMail.__table__.delete().where(OutboxMail.alarm_id.in_(ids)))
+        session.execute(alarms.delete().where(alarms.c.id.in_(ids)))
+        return len(ids)
+
+    @classmethod
+    def totals(cls, session, node):
+        """ Returns the number and the total duration (in seconds) of the
+        folded alarms of a node. """
+
+        count, downtime = session.execute(select(func.sum(AlarmRollup.count), func.sum(AlarmRollup.downtime_seconds)).
+                                          where(AlarmRollup.node_id == node.id)).one()
+        return count or 0, downtime or 0
+
+
+class NodeChange(Base):
+    """ Log of inserted and deleted nodes. The worker keeps its nodes in
+    memory and only applies the changes from here (e.g. a subscription to a
+    new node in the webserver), instead of reloading all nodes every cycle,
+    see NodeSet.refresh(). """
+
+    __tablename__ = 'node_changes'
+    # ids are never reused, as they are used as watermark
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    node_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, default=func.now())
+
+    @classmethod
+    def latest_id(cls, session):
+        return session.execute(select(func.max(NodeChange.id))).scalar() or 0
+
+    @classmethod
+    def prune(cls, session, before):
+        session.execute(NodeChange.__table__.delete().where(NodeChange.created_at < before))
+
+
+class NodeEvent(Base):
+    """ Log of the state changes and alarms of the nodes, which are pushed
+    to the open web pages, see webserver.events(). The data is the json of
+    the event, as it is sent to the browser. """
+
+    __tablename__ = 'node_events'
+    # ids are never reused, as they are used as Last-Event-ID
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    nodeid = Column(String(32), nullable=False)
+    data = Column(String, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+    @staticmethod
+    def event_data(node, alarm=None):
+        def fmt(t):
+            return str(t) if t is not None else None
+
+        data = {'nodeid': node.nodeid, 'constitution': node.constitution, 'alarm': None}
+        if alarm is not None:
+            data['alarm'] = {'id': alarm.id,
+                             'alarm_at': fmt(alarm.alarm_at),
+                             'resolved_at': fmt(alarm.resolved_at),
+                             'duration': alarm.duration_str}
+        return json.dumps(data)
+
+    @classmethod
+    def publish(cls, session, changes):
+        """ Logs the given (node, alarm or None) tuples. """
+
+        if changes:
+            session.execute(NodeEvent.__table__.insert(),
+                            [{'nodeid': node.nodeid, 'data': cls.event_data(node, alarm)}
+                             for node, alarm in changes])
+
+    @classmethod
+    def latest_id(cls, session):
+        return session.execute(select(func.max(NodeEvent.id))).scalar() or 0
+
+    @classmethod
+    def since(cls, session, after_id):
+        """ Returns (id, nodeid, data) of the events after after_id. """
+
+        return session.execute(select(NodeEvent.id, NodeEvent.nodeid, NodeEvent.data).
+                               where(NodeEvent.id > after_id).
+                               order_by(NodeEvent.id)).all()
+
+    @classmethod
+    def prune(cls, session, before):
+        session.execute(NodeEvent.__table__.delete().where(NodeEvent.created_at < before))
+
+
+@event.listens_for(Node, 'after_insert')
+def _log_node_insert(mapper, connection, node):
+    connection.execute(NodeChange.__table__.insert().values(node_id=node.id, deleted=False))
+
+
+@event.listens_for(Node, 'after_delete')
+def _log_node_delete(mapper, connection, node):
+    connection.execute(NodeChange.__table__.insert().values(node_id=node.id, deleted=True))
+
+
+class WorkerLease(Base):
+    """ The owner of each shard of the nodes, if several workers share
+    them (WORKER_SHARDS > 1). Every worker prefers one shard, which it takes
+    over from any worker not preferring it. All other shards are taken by
+    whoever finds their lease expired first, so the shards of a dead worker
+    move to the others within WORKER_LEASE_SECONDS. """
+
+    __tablename__ = 'worker_leases'
+
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(64))
+    # whether this is the preferred shard of the owner
+    preferred = Column(Boolean, nullable=False, default=False)
+    expires_at = Column(DateTime)
+
+    @classmethod
+    def acquire(cls, session, owner, preferred, shards, duration, now=None):
+        """ Renews the leases of owner and takes the preferred shard and
+        all expired shards. Returns the set of shards owned by owner. """
+
+        if now is None:
+            now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(seconds=duration)
+        table = WorkerLease.__table__
+
+        existing = set(session.execute(select(WorkerLease.shard)).scalars())
+        missing = [{'shard': shard, 'owner': None, 'preferred': False, 'expires_at': now}
+                   for shard in range(shards) if shard not in existing]
+        if missing:
+            session.execute(table.insert().prefix_with('OR IGNORE'), missing)
+
+        # the shard count might have been lowered
+        session.execute(table.delete().where(table.c.shard >= shards))
+
+        session.execute(table.update().
+                        where(table.c.owner == owner).
+                        values(expires_at=expires_at))
+        session.execute(table.update().
+                        where(table.c.shard == preferred).
+                        where((table.c.owner == owner) | (table.c.preferred == False) |
+                              (table.c.expires_at <= now)).
+                        values(owner=owner, preferred=True, expires_at=expires_at))
+        session.execute(table.update().
+                        where(table.c.expires_at <= now).
+                        values(owner=owner, preferred=False, expires_at=expires_at))
+
+        owned = set(session.execute(select(WorkerLease.shard).where(WorkerLease.owner == owner)).scalars())
+        session.commit()
+        return owned
+
+    @classmethod
+    def release(cls, session, owner):
+        """ Lets the other workers take the shards of owner right away. """
+
+        table = WorkerLease.__table__
+        session.execute(table.update().
+                        where(table.c.owner == owner).
+                        values(owner=None, preferred=False, expires_at=datetime.datetime.now()))
+        session.commit()
+
+
+class DataVersion(Base):
+    """ A counter, which is increased whenever nodes or subscriptions change
+    in a way that is visible on the web pages. Caches in the webserver
+    processes are only valid as long as this does not change. """
+
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, session):
+        version = session.execute(select(DataVersion.version).where(DataVersion.id == 1)).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls, session):
+        table = DataVersion.__table__
+        res = session.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1))
+        if res.rowcount == 0:
+            session.execute(table.insert().values(id=1, version=1))
+
+
+# Changes of these attributes are visible on the web pages.
+_VERSIONED_ATTRIBUTES = {
+    Node: ['name', 'state', 'is_state_unknown'],
+    Subscription: ['send_notifications'],
+}
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_data_version(session, flush_context, instances):
+    """ Bumps the DataVersion, whenever nodes or subscriptions are changed
+    through the orm. Bulk updates have to call DataVersion.bump() on their
+    own. """
+
+    def versioned(obj):
+        return type(obj) in _VERSIONED_ATTRIBUTES
+
+    changed = any(versioned(obj) for obj in session.new) \
+        or any(versioned(obj) for obj in session.deleted)
+
+    if not changed:
+        for obj in session.dirty:
+            if not versioned(obj):
+                continue
+            state = inspect(obj)
+            if any(state.attrs[attr].history.has_changes() for attr in _VERSIONED_ATTRIBUTES[type(obj)]):
+                changed = True
+                break
+
+    if changed:
+        DataVersion.bump(session)
+
+
+_engines = {}
+
+
+def configure_sqlite_connection(dbapi_connection, readonly):
+    cursor = dbapi_connection.cursor()
+    if not readonly:
+        # This only has an effect on a new db, so it has to come first.
+        # Older dbs are converted by retention.py --convert.
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # The journal mode is stored in the db file, so this is only
+        # necessary once, but it does not hurt either.
+        cursor.execute('PRAGMA journal_mode=WAL')
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute('PRAGMA %s=%s' % (name, value))
+    if readonly:
+        cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+
+def get_engine(readonly=False):
+    """ Returns the process wide engine. All entry points use this, so all
+    connections are configured the same way. The readonly engine has its
+    own connection pool with query only connections. """
+
+    engine = _engines.get(readonly)
+    if engine is None:
+        engine = create_engine(SQLITE_URI)
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            configure_sqlite_connection(dbapi_connection, readonly)
+
+        _engines[readonly] = engine
+
+    return engine
+
+
+class RoutingSession(Session):
+    """ Session, which runs all queries on the readonly engine and only
+    flushes and explicit INSERT/UPDATE/DELETE statements on the read-write
+    engine. This is used by the webserver, which mostly reads. Note, that
+    queries do not see changes, which are flushed but not yet committed. """
+
+    def flush(self, objects=None):
+        # autoflush and commit() flush through here as well
+        self.info['flushing'] = True
+        try:
+            super().flush(objects)
+        finally:
+            self.info['flushing'] = False
 
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get('flushing') or isinstance(clause, (Insert, Update, Delete)):
+            return get_engine()
+        return get_engine(readonly=True)
 
-def get_session():
-    engine = create_engine(SQLITE_URI)
 
-    Session = sessionmaker()
-    Session.configure(bind=engine)
+def get_session(expire_on_commit=True):
+    Session = sessionmaker(expire_on_commit=expire_on_commit)
+    Session.configure(bind=get_engine())
     return Session()
 
 
 def init_db():
-    engine = create_engine(SQLITE_URI)
+    engine = get_engine()
 
-    classes = [Node, User, Alarm, Subscription]
+    classes = [Node, User, Alarm, Subscription, OutboxMail, DataVersion, NodeChange, NodeEvent, WorkerLease, AlarmRollup]
 
     for cls in classes:
         cls.metadata.create_all(engine)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name: (type, help, buckets)
+METRICS = {
+    'keepitup_worker_cycles_total': ('counter', "Cycles of the worker.", None),
+    'keepitup_worker_cycle_seconds': ('histogram', "Duration of a worker cycle (without the sleep).", SECONDS_BUCKETS),
+    'keepitup_worker_phase_seconds': ('histogram', "Duration of the phases of a worker cycle.", SECONDS_BUCKETS),
+    'keepitup_worker_last_cycle_timestamp_seconds': ('gauge', "Unix time of the end of the last worker cycle.", None),
+    'keepitup_worker_skipped_ticks_total': ('counter', "Ticks skipped, because a worker cycle overran.", None),
+    'keepitup_worker_deadline_misses_total': ('counter', "Worker phases, which missed their deadline.", None),
+    'keepitup_worker_shards': ('gauge', "Shards of the nodes leased by the worker, if several workers share them.", None),
+    'keepitup_worker_nodes': ('gauge', "Nodes checked in the last worker cycle.", None),
+    'keepitup_worker_nodes_written': ('gauge', "Nodes, which have changed in the last nodes.json and were written.", None),
+    'keepitup_worker_nodes_processed_total': ('counter', "Nodes checked by the worker.", None),
+    'keepitup_worker_alarms_total': ('counter', "Alarms created (kind=alarm) or resolved (kind=resolved).", None),
+    'keepitup_worker_mails_queued_total': ('counter', "Notification mails queued in the outbox.", None),
+    'keepitup_nodes_json_downloads_total': ('counter', "Downloads of the nodes.json files by source and result "
+                                                     "(modified, unchanged or failed).", None),
+    'keepitup_nodes_json_bytes': ('gauge', "Size of the last downloaded nodes.json (encoding=identity) "
+                                           "and the bytes transferred for it (encoding=transfer).", None),
+    'keepitup_smtp_send_seconds': ('histogram', "Duration of sending a single mail over smtp.", SECONDS_BUCKETS),
+    'keepitup_mails_total': ('counter', "Mails handled by the mail sender by result.", None),
+    'keepitup_mail_digests_total': ('counter', "Digests sent by the mail sender, each combining several mails.", None),
+    'keepitup_http_requests_total': ('counter', "Http requests by endpoint and status.", None),
+    'keepitup_http_request_seconds': ('histogram', "Duration of http requests by endpoint.", SECONDS_BUCKETS),
+    'keepitup_http_sql_queries': ('histogram', "Sql queries per http request by endpoint.", COUNT_BUCKETS),
+}
+
+
+class Metrics:
+    """ The metrics of a single process. They are kept in memory and written
+    to <directory>/<name>.json by publish(), where the webserver picks them
+    up, see collect(). "{pid}" in the name is replaced by the process id,
+    for processes which exist more than once (like the gunicorn workers). """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self._values = {}
+        self._lock = threading.Lock()
+        # publish() is called by the threads of the webserver concurrently
+        self._publish_lock = threading.Lock()
+        self._published_at = 0
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError("unknown metric " + name)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        buckets = METRICS[name][2]
+
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                # counts per bucket (not cumulative) and one for +Inf
+                h = self._values[key] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+
+            i = next((i for i, le in enumerate(buckets) if value <= le), len(buckets))
+            h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """ Observes the time spent in the with block in seconds. """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name.format(pid=os.getpid()) + '.json')
+
+    def publish(self, min_interval=0):
+        """ Writes the metrics to the file. If they have been written less
+        than min_interval seconds ago, nothing is done. """
+
+        if time.monotonic() - self._published_at < min_interval:
+            return
+
+        # The values are taken and written under the lock, so a file written
+        # by another thread never replaces a newer one.
+        with self._publish_lock:
+            now = time.monotonic()
+            if now - self._published_at < min_interval:
+                return
+            self._published_at = now
+
+            with self._lock:
+                values = [[name, dict(labels), value] for (name, labels), value in self._values.items()]
+                data = json.dumps({'pid': os.getpid(), 'values': values})
+
+            self._write(data)
+
+    def _write(self, data):
+        path = self.path
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        except OSError:
+            # metrics are never worth crashing for
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                # mkstemp creates the file only readable by the owner
+                os.fchmod(f.fileno(), 0o644)
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory):
+    """ Merges the metrics of all processes, which published to directory,
+    and returns them in the Prometheus text format. Counters and histograms
+    are summed up, gauges are labelled with the process. Files of processes,
+    which do not exist anymore, are removed. """
+
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if not _alive(data['pid']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+
+        process = os.path.basename(path)[:-len('.json')]
+        for name, labels, value in data['values']:
+            if name not in METRICS:
+                continue
+
+            kind = METRICS[name][0]
+            if kind == 'gauge':
+                labels['process'] = process
+            key = name, tuple(sorted(labels.items()))
+
+            if kind == 'histogram':
+                h = merged.setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0, 'count': 0})
+                h['buckets'] = [a + b for a, b in zip(h['buckets'], value['buckets'])]
+                h['sum'] += value['sum']
+                h['count'] += value['count']
+            elif kind == 'counter':
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = value
+
+    def fmt_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    lines = []
+    for name, (kind, help, buckets) in METRICS.items():
+        samples = sorted((labels, value) for (n, labels), value in merged.items() if n == name)
+        if not samples:
+            continue
+
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines += ['%s%s %s' % (name, fmt_labels(labels), value)]
+                continue
+
+            cumulative = 0
+            for le, count in zip(list(buckets) + ['+Inf'], value['buckets']):
+                cumulative += count
+                lines += ['%s_bucket%s %d' % (name, fmt_labels(labels + (('le', str(le)),)), cumulative)]
+            lines += ['%s_sum%s %s' % (name, fmt_labels(labels), value['sum'])]
+            lines += ['%s_count%s %d' % (name, fmt_labels(labels), value['count'])]
+
+    return '\n'.join(lines) + '\n'
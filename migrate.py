@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+""" Brings the database to the current DB_VERSION. A new database is created
+from the models directly. Otherwise all migrations from migrations/, which
+have not been applied yet, are applied in order. Each migration runs in its
+own transaction together with the update of the DBVersion, so a failed
+migration leaves the database untouched.
+
+A migration is a file migrations/NNN_description.py, where NNN is the
+DBVersion after the migration. It defines upgrade(db), which gets a
+connection with an open transaction. """
+
+from main import *
+import glob
+import importlib.util
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def find_migrations():
+    """ Returns (version, path) of all migrations, ordered by version. """
+
+    migrations = []
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '[0-9][0-9][0-9]_*.py'))):
+        migrations += [(int(os.path.basename(path)[:3]), path)]
+    return migrations
+
+
+def load_migration(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location('migration_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_migration_engine():
+    """ pysqlite does not start a transaction before DDL statements on its
+    own. Here, sqlalchemy emits BEGIN itself, so schema changes are rolled
+    back as well, if a migration fails. """
+
+    engine = create_engine(SQLITE_URI)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        configure_sqlite_connection(dbapi_connection, readonly=False)
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+def migrate():
+    migrations = find_migrations()
+    if not migrations or migrations[-1][0] != DB_VERSION:
+        raise Exception('The latest migration does not match DB_VERSION %d!' % DB_VERSION)
+
+    engine = get_migration_engine()
+
+    with engine.begin() as conn:
+        tables = inspect(conn).get_table_names()
+
+        if 'nodes' in tables:
+            # Databases before the first migration have no db_version.
+            DBVersion.__table__.create(conn, checkfirst=True)
+            version = DBVersion.get(conn)
+
+    if 'nodes' not in tables:
+        init_db()
+        print("migrate.py: Created a new database. (version %d)" % DB_VERSION)
+        return
+
+    pending = [(v, path) for v, path in migrations if v > version]
+    if not pending:
+        print("migrate.py: The database is up to date. (version %d)" % version)
+        return
+
+    for v, path in pending:
+        migration = load_migration(path)
+
+        with engine.begin() as conn:
+            migration.upgrade(conn)
+            DBVersion.set(conn, v)
+
+        print("migrate.py: Applied " + os.path.basename(path) + ". (version %d)" % v)
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+""" Adds the table outbox for queued notification mails. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS outbox (
+    	id INTEGER NOT NULL,
+    	user_id INTEGER NOT NULL,
+    	alarm_id INTEGER NOT NULL,
+    	kind VARCHAR(16) NOT NULL,
+    	created_at DATETIME,
+    	attempts INTEGER,
+    	next_attempt_at DATETIME,
+    	sent_at DATETIME,
+    	msgid VARCHAR(995),
+    	last_error VARCHAR(255),
+    	PRIMARY KEY (id),
+    	FOREIGN KEY(user_id) REFERENCES users (id),
+    	FOREIGN KEY(alarm_id) REFERENCES alarms (id)
+    );
+    """))
@@ -0,0 +1,9 @@
+#!/usr/bin/python3
+
+""" Adds the column language to users. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text('ALTER TABLE users ADD COLUMN language VARCHAR(8)'))
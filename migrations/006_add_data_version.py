@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+
+""" Adds the table data_version. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS data_version (
+    	id INTEGER NOT NULL,
+    	version INTEGER NOT NULL,
+    	PRIMARY KEY (id)
+    );
+    """))
+    db.execute(text('INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 1)'))
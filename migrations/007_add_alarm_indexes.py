@@ -0,0 +1,10 @@
+#!/usr/bin/python3
+
+""" Adds indexes for the alarm history and the open alarm of a node. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_alarms_node_id_id ON alarms (node_id, id)'))
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_alarms_node_id_resolved_at ON alarms (node_id, resolved_at)'))
@@ -0,0 +1,14 @@
+#!/usr/bin/python3
+
+""" Adds indexes for the remaining hot lookups: the subscriptions of a node,
+nodes by state and the pending mails in the outbox. alarms.node_id is already
+covered by the indexes of migration 007. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_subscriptions_node_id ON subscriptions (node_id)'))
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_nodes_state ON nodes (state)'))
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_outbox_alarm_id ON outbox (alarm_id)'))
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (next_attempt_at) WHERE sent_at IS NULL'))
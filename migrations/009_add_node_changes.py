@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+
+""" Adds the table node_changes, the log of inserted and deleted nodes. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS node_changes (
+    	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    	node_id INTEGER NOT NULL,
+    	deleted BOOLEAN NOT NULL,
+    	created_at DATETIME
+    );
+    """))
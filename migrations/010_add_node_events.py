@@ -0,0 +1,17 @@
+#!/usr/bin/python3
+
+""" Adds the table node_events, the log of state changes and alarms, which is
+pushed to the web pages. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS node_events (
+    	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    	nodeid VARCHAR(32) NOT NULL,
+    	data VARCHAR NOT NULL,
+    	created_at DATETIME
+    );
+    """))
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+
+""" Adds the table worker_leases, the owners of the shards of the nodes, if
+several workers share them. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS worker_leases (
+    	shard INTEGER NOT NULL,
+    	owner VARCHAR(64),
+    	preferred BOOLEAN NOT NULL,
+    	expires_at DATETIME,
+    	PRIMARY KEY (shard)
+    );
+    """))
@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+
+""" Adds the table alarm_rollups, which holds the folded old alarms, and an
+index to find the old alarms. """
+
+from sqlalchemy import text
+
+
+def upgrade(db):
+    db.execute(text("""
+    CREATE TABLE IF NOT EXISTS alarm_rollups (
+    	node_id INTEGER NOT NULL,
+    	day DATE NOT NULL,
+    	count INTEGER NOT NULL,
+    	downtime_seconds FLOAT NOT NULL,
+    	PRIMARY KEY (node_id, day),
+    	FOREIGN KEY(node_id) REFERENCES nodes (id)
+    );
+    """))
+    db.execute(text('CREATE INDEX IF NOT EXISTS ix_alarms_resolved_at ON alarms (resolved_at)'))
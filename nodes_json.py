@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+
+import bisect
+import codecs
+import datetime
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+# Size of the chunks, which are read from the http body at once.
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = json.decoder.WHITESPACE
+
+
+def parse_time(s):
+    """ Parses a timestamp from the nodes.json. Meshviewer always emits
+    ISO-8601, which datetime.fromisoformat() handles a lot faster than
+    dateutil. Everything else is still handed over to dateutil. """
+
+    try:
+        if s.endswith('Z'):
+            # fromisoformat() only understands 'Z' since python 3.11
+            s = s[:-1] + '+00:00'
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        from dateutil.parser import parse as dateutil_parse_time
+        return dateutil_parse_time(s)
+
+
+class NodesJSONStream:
+    """ Incremental parser for the nodes.json. Iterating over this object
+    yields the entries of the toplevel "nodes" array one by one, while the
+    underlying chunks are consumed. So only a single node (and one chunk) is
+    kept in memory at once, regardless of the size of the nodes.json.
+
+    The toplevel "timestamp" is stored in self.timestamp as soon as it has
+    been read. Note, that it might appear after the "nodes" array. The number
+    of bytes consumed so far is in self.size. """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self.timestamp = None
+        self.size = 0
+
+    def _fill(self):
+        """ Reads the next chunk into the buffer. Returns False on EOF. """
+
+        if self._eof:
+            return False
+
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            chunk = b''
+
+        if isinstance(chunk, bytes):
+            self.size += len(chunk)
+            chunk = self._utf8.decode(chunk, final=self._eof)
+
+        # drop everything, which has already been consumed
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return
+            if not self._fill():
+                raise ValueError("unexpected end of nodes.json")
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self._buf[self._pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("expected '%s' at offset %d of nodes.json" % (char, self._pos))
+        self._pos += 1
+
+    def _value(self):
+        """ Decodes the next json value. If the value is not complete yet,
+        more chunks are read until it is. """
+
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A number might be cut off at the end of the buffer.
+            if end == len(self._buf) and not self._eof:
+                self._fill()
+                continue
+
+            self._pos = end
+            return value
+
+    def _array(self):
+        """ Yields the items of the json array at the current position. """
+
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield self._value()
+
+            c = self._peek()
+            self._pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("expected ',' or ']' in array of nodes.json")
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+
+            if key == 'nodes':
+                yield from self._array()
+            elif self._peek() == '[':
+                # other arrays (e.g. "links") are skipped item by item, so
+                # they are never held in memory completely
+                for _ in self._array():
+                    pass
+            else:
+                value = self._value()
+                if key == 'timestamp':
+                    self.timestamp = value
+
+            c = self._peek()
+            self._pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                raise ValueError("expected ',' or '}' in nodes.json")
+
+
+_http_session = None
+
+
+def get_http_session():
+    """ Returns the process wide http session. It keeps the connections to
+    the map server alive between downloads and asks for compressed
+    responses. requests is only imported here, so the processes, which
+    never download, do not load it. """
+
+    global _http_session
+
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+        _http_session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    return _http_session
+
+
+class NodesJSONFetcher:
+    """ Downloads a nodes.json conditionally. The validators (ETag and
+    Last-Modified) of the last complete download are sent along with the
+    next request, so the server can answer with 304 Not Modified. The
+    upstream timestamp of the last ingested file is remembered as well, so
+    the caller can stop parsing as soon as it sees the same timestamp
+    again. """
+
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.timestamp = None
+
+    def reset(self):
+        """ Forgets everything about the last download, so the next fetch()
+        is unconditional. """
+
+        self.etag = None
+        self.last_modified = None
+        self.timestamp = None
+
+    def fetch(self, timeout=None):
+        """ Starts the download. Returns None, if the nodes.json has not
+        been modified since the last download, otherwise the (streamed)
+        response. Raises requests.RequestException on errors. """
+
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        res = get_http_session().get(self.url, headers=headers, stream=True, timeout=timeout)
+
+        if res.status_code == 304:
+            res.close()
+            return None
+
+        if not res.ok:
+            res.close()
+            res.raise_for_status()
+
+        return res
+
+    def commit(self, res, timestamp):
+        """ Stores the validators of a response, after it has been ingested
+        completely. """
+
+        self.etag = res.headers.get('ETag')
+        self.last_modified = res.headers.get('Last-Modified')
+        self.timestamp = timestamp
+
+
+def _chunks_until(res, started, deadline):
+    """ Yields the decoded chunks of the body as they arrive. Raises
+    TimeoutError after deadline seconds, even if the server keeps sending a
+    few bytes now and then, so the read timeout never fires. """
+
+    import requests
+    import urllib3
+
+    while True:
+        if deadline is not None and time.monotonic() - started > deadline:
+            raise TimeoutError()
+
+        try:
+            # Unlike iter_content(), this does not wait for a whole chunk,
+            # but returns what has arrived with a single read.
+            chunk = res.raw.read1(CHUNK_SIZE, decode_content=True)
+        except urllib3.exceptions.HTTPError as e:
+            # as iter_content() would raise it
+            raise requests.ConnectionError(e)
+
+        if not chunk:
+            return
+        yield chunk
+
+
+class NodesJSONDownload:
+    """ The result of NodesJSONSource.download(). """
+
+    def __init__(self, res, timestamp, records, spool, size, transfer_size):
+        self.res = res
+        self.timestamp = timestamp
+        self.records = records
+        self.spool = spool
+        self.size = size
+        self.transfer_size = transfer_size
+
+
+class NodesJSONSource:
+    """ A single nodes.json. It keeps the nodes of its last complete
+    download as (nodeid, hostname, lastseen) tuples in self.records, with
+    lastseen parsed. Optionally all nodes (unfiltered and unparsed) are
+    spooled to a temporary file, see all_records(), so they do not stay in
+    memory between the updates.
+
+    download() does not change the source, so it can run in a thread, which
+    might be abandoned. Only commit() does. """
+
+    def __init__(self, url):
+        self.fetcher = NodesJSONFetcher(url)
+        self.records = []
+        self.spool = None
+        self.size = None
+        self.transfer_size = None
+
+    @property
+    def url(self):
+        return self.fetcher.url
+
+    @property
+    def timestamp(self):
+        """ The upstream timestamp of the last complete download. """
+        return self.fetcher.timestamp
+
+    def reset(self):
+        self.fetcher.reset()
+        self.records = []
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = None
+
+    def all_records(self):
+        """ Yields all nodes of the last complete download as (nodeid,
+        hostname, lastseen) tuples, if it has been downloaded with keep_all.
+        lastseen is not parsed. """
+
+        if self.spool is None:
+            return
+
+        self.spool.seek(0)
+        for line in self.spool:
+            yield tuple(json.loads(line))
+
+    def download(self, filter_nodeids=None, keep_all=False, deadline=None):
+        """ Downloads and parses the nodes.json. If filter_nodeids is given,
+        all other nodes are dropped from the records. Returns a
+        NodesJSONDownload, or None if the server answered 304 Not Modified.
+        If the upstream timestamp did not move, the records of the download
+        are None.
+
+        Raises requests.RequestException, TimeoutError if the download took
+        longer than deadline seconds, or KeyError, TypeError or ValueError
+        if the format is wrong. """
+
+        started = time.monotonic()
+
+        res = self.fetcher.fetch(timeout=deadline)
+        if res is None:
+            # 304 Not Modified
+            return None
+
+        records = []
+        # all nodes are written to disk right away, see all_records()
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8') if keep_all else None
+        try:
+            with res:
+                stream = NodesJSONStream(_chunks_until(res, started, deadline))
+                for node in stream:
+                    # Usually the timestamp is located in front of the nodes,
+                    # so we can stop early if it did not move.
+                    if stream.timestamp is not None and stream.timestamp == self.fetcher.timestamp:
+                        break
+
+                    nodeinfo = node['nodeinfo']
+                    nodeid = nodeinfo['node_id']
+                    lastseen = node.get('lastseen')
+
+                    if spool is not None:
+                        spool.write(json.dumps([nodeid, nodeinfo['hostname'], lastseen]) + '\n')
+
+                    if filter_nodeids is not None and nodeid not in filter_nodeids:
+                        continue
+
+                    records += [(nodeid, nodeinfo['hostname'], parse_time(lastseen) if lastseen else None)]
+
+                if stream.timestamp is None:
+                    raise KeyError('timestamp')
+
+                if stream.timestamp == self.fetcher.timestamp:
+                    if spool is not None:
+                        spool.close()
+                    return NodesJSONDownload(res, stream.timestamp, None, None, None, None)
+
+                return NodesJSONDownload(res, stream.timestamp, records, spool,
+                                         stream.size, res.raw.tell())
+        except BaseException:
+            if spool is not None:
+                spool.close()
+            raise
+
+    def commit(self, download):
+        self.fetcher.commit(download.res, download.timestamp)
+        if download.records is None:
+            return
+
+        self.records = download.records
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = download.spool
+        self.size = download.size
+        self.transfer_size = download.transfer_size
+
+
+class NodesSnapshot:
+    """ Read only view on a nodes snapshot file. The worker publishes such a
+    file every time it ingests a new nodes.json, so the webserver processes
+    do not need to download it themselves.
+
+    The file is memory mapped. It only contains nodeid, hostname and
+    lastseen of every node, sorted by nodeid, and nothing is decoded until
+    it is actually accessed. The layout is:
+
+        header: magic, format version, node count, timestamp (offset, length)
+        index:  per node (offset, length) of nodeid, hostname and lastseen
+        blob:   all strings, utf-8 encoded
+
+    Offsets are relative to the start of the blob. """
+
+    MAGIC = b'KIUNODES'
+    FORMAT_VERSION = 1
+    HEADER = struct.Struct('<8sHHIII')
+    RECORD = struct.Struct('<IHIHIH')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, count, ts_off, ts_len = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC or version != self.FORMAT_VERSION:
+            raise ValueError("%s is not a nodes snapshot of version %d" % (path, self.FORMAT_VERSION))
+
+        self._count = count
+        self._index_start = self.HEADER.size
+        self._blob_start = self._index_start + count * self.RECORD.size
+        self.timestamp = self._str(ts_off, ts_len)
+
+    def __len__(self):
+        return self._count
+
+    def _str(self, off, length):
+        start = self._blob_start + off
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _record(self, i):
+        return self.RECORD.unpack_from(self._mm, self._index_start + i * self.RECORD.size)
+
+    def _nodeid_bytes(self, i):
+        off, length = self._record(i)[:2]
+        start = self._blob_start + off
+        return self._mm[start:start + length]
+
+    def _node(self, i):
+        nid_off, nid_len, host_off, host_len, seen_off, seen_len = self._record(i)
+        lastseen = self._str(seen_off, seen_len) if seen_len else None
+        return self._str(nid_off, nid_len), self._str(host_off, host_len), lastseen
+
+    def __iter__(self):
+        """ Yields (nodeid, hostname, lastseen) for every node. lastseen is
+        the unparsed string from the nodes.json or None. """
+
+        for i in range(self._count):
+            yield self._node(i)
+
+    def find(self, nodeid):
+        """ Binary search for a single node. Only this node is decoded. """
+
+        key = nodeid.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._nodeid_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._count and self._nodeid_bytes(lo) == key:
+            return self._node(lo)
+        return None
+
+    @classmethod
+    def publish(cls, path, timestamp, nodes):
+        """ Writes a new snapshot. nodes is an iterable of (nodeid, hostname,
+        lastseen) tuples. A node might be in there more than once (e.g. from
+        several nodes.json files), then the newest lastseen wins. The file
+        is replaced atomically, so readers either see the old or the new
+        snapshot. """
+
+        blob = bytearray()
+
+        def add(s):
+            b = s.encode('utf-8') if s is not None else b''
+            off = len(blob)
+            blob.extend(b)
+            return off, len(b)
+
+        nodes = sorted(((nodeid.encode('utf-8'), hostname, lastseen) for nodeid, hostname, lastseen in nodes),
+                       key=lambda node: node[0])
+
+        ts_off, ts_len = add(timestamp)
+        index = bytearray()
+        count = 0
+        for nodeid, group in itertools.groupby(nodes, key=lambda node: node[0]):
+            _, hostname, lastseen = next(group)
+            for _, other_hostname, other_lastseen in group:
+                if other_lastseen and (not lastseen or parse_time(other_lastseen) > parse_time(lastseen)):
+                    hostname, lastseen = other_hostname, other_lastseen
+
+            nid_off = len(blob)
+            blob.extend(nodeid)
+            index.extend(cls.RECORD.pack(nid_off, len(nodeid), *add(hostname), *add(lastseen)))
+            count += 1
+
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.FORMAT_VERSION, 0, count, ts_off, ts_len))
+            f.write(index)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+
+_snapshots = {}
+
+
+def open_snapshot(path):
+    """ Returns the current NodesSnapshot at path, or None if there is none.
+    The mapping is reused as long as the file has not been replaced. """
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    snapshot = _snapshots.get(path)
+    if snapshot is None or (snapshot.stat.st_ino, snapshot.stat.st_mtime_ns) != (st.st_ino, st.st_mtime_ns):
+        try:
+            snapshot = NodesSnapshot(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        _snapshots[path] = snapshot
+
+    return snapshot
+
+
+class NodeSearchIndex:
+    """ In memory index over the hostnames and nodeids of all nodes, for the
+    search on the subscribe page. Matches are ranked: first nodes, whose
+    hostname or nodeid starts with the query, then nodes, which contain it
+    somewhere in the hostname, and last nodes, which contain it somewhere in
+    the nodeid. The search is case insensitive, and within a rank the nodes
+    are sorted by hostname. Every node is only returned once. """
+
+    def __init__(self, records):
+        """ records is an iterable of (nodeid, hostname, ...) tuples, e.g. a
+        NodesSnapshot. """
+
+        nodes = sorted(((hostname or '').lower(), hostname or '', nodeid) for nodeid, hostname, *_ in records)
+        self.names = [name for name, _, _ in nodes]
+        self.hostnames = [hostname for _, hostname, _ in nodes]
+        self.nodeids = [nodeid for _, _, nodeid in nodes]
+
+        # nodeid -> position, sorted by nodeid for the prefix search
+        self._by_nodeid = sorted((nodeid.lower(), i) for i, nodeid in enumerate(self.nodeids))
+        self._nodeid_keys = [nodeid for nodeid, _ in self._by_nodeid]
+
+        # All names and all nodeids in one string each, so the substring
+        # search runs in C.
+        self._names = self._haystack(self.names)
+        self._nodeids = self._haystack([nodeid.lower() for nodeid in self.nodeids])
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def _haystack(keys):
+        """ Returns the keys joined by newlines and the offset of every key
+        in there. """
+
+        offsets = []
+        offset = 0
+        for key in keys:
+            offsets += [offset]
+            offset += len(key) + 1
+        return '\n'.join(keys), offsets
+
+    @staticmethod
+    def _find(haystack, query):
+        """ Yields the positions of the keys, which contain query, in
+        order. """
+
+        text, offsets = haystack
+        pos = text.find(query)
+        while pos != -1:
+            i = bisect.bisect_right(offsets, pos) - 1
+            yield i
+            if i + 1 == len(offsets):
+                return
+            # continue with the next key
+            pos = text.find(query, offsets[i + 1])
+
+    def _prefix(self, keys, query):
+        lo = bisect.bisect_left(keys, query)
+        hi = bisect.bisect_left(keys, query + '￿')
+        return lo, hi
+
+    def _matches(self, query):
+        """ Yields the positions of the matching nodes in rank order. A node
+        might be yielded more than once. """
+
+        if not query:
+            yield from range(len(self.names))
+            return
+
+        lo, hi = self._prefix(self.names, query)
+        yield from range(lo, hi)
+
+        lo, hi = self._prefix(self._nodeid_keys, query)
+        yield from sorted(i for _, i in self._by_nodeid[lo:hi])
+
+        yield from self._find(self._names, query)
+        yield from self._find(self._nodeids, query)
+
+    def search(self, query, offset=0, limit=50):
+        """ Returns one page of (nodeid, hostname) tuples and whether there
+        are more results after it. """
+
+        query = query.strip().lower()
+        results = []
+        seen = set()
+        skipped = 0
+
+        for i in self._matches(query):
+            if i in seen:
+                continue
+            seen.add(i)
+
+            if skipped < offset:
+                skipped += 1
+                continue
+
+            if len(results) == limit:
+                return results, True
+            results += [(self.nodeids[i], self.hostnames[i])]
+
+        return results, False
+
+
+_search_indexes = {}
+
+
+def open_search_index(path):
+    """ Returns the NodeSearchIndex for the current NodesSnapshot at path, or
+    None if there is no snapshot. The index is only rebuilt, when the
+    snapshot has been replaced. """
+
+    snapshot = open_snapshot(path)
+    if snapshot is None:
+        return None
+
+    cached = _search_indexes.get(path)
+    if cached is None or cached[0] is not snapshot:
+        cached = _search_indexes[path] = (snapshot, NodeSearchIndex(snapshot))
+    return cached[1]
@@ -1,41 +1,144 @@
 #!/usr/bin/env python3
 
 from main import *
+from availability import AvailabilityStore
+from metrics import Metrics
+from scheduler import CycleScheduler
+from contextlib import contextmanager
+import argparse
+import signal
+import socket
 import time
 
-session = get_session()
-nodeset = NodeSet()
+parser = argparse.ArgumentParser(description="Checks the nodes and queues the notification mails.")
+parser.add_argument('--shard', type=int, default=0,
+                    help="preferred shard of this worker, if WORKER_SHARDS > 1 (default: 0)")
+args = parser.parse_args()
+
+# With several workers, every one only checks the nodes of the shards it
+# has leased, see WorkerLease.
+sharded = WORKER_SHARDS > 1
+owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+# The nodes are kept in memory between the cycles (see NodeSet.refresh()),
+# so they must not be expired by the commits.
+session = get_session(expire_on_commit=False)
+
+if sharded:
+    nodeset = NodeSet(WorkerLease.acquire(session, owner, args.shard, WORKER_SHARDS, WORKER_LEASE_SECONDS),
+                      WORKER_SHARDS)
+else:
+    nodeset = NodeSet()
 
 nodeset.update_from_db(session)
 
 print("ping_worker.py, " + str(len(nodeset.nodes)) + " nodes loaded.")
+if sharded:
+    print("shards: " + ", ".join(str(shard) for shard in sorted(nodeset.shards)))
+
+# The cache is kept between the cycles, so the nodes.json is only downloaded
+# and ingested again, if it has actually changed.
+nodes_json_cache = NodesJSONCache()
+availability = AvailabilityStore(AVAILABILITY_DIR)
+metrics = Metrics(METRICS_DIR, 'worker-{pid}' if sharded else 'worker')
+# The cycles start on fixed ticks, see CycleScheduler.
+scheduler = CycleScheduler(WORKER_INTERVAL, metrics=metrics)
+
+
+@contextmanager
+def phase(name):
+    with metrics.time('keepitup_worker_phase_seconds', phase=name), \
+            scheduler.deadline(name, WORKER_PHASE_DEADLINES.get(name)):
+        yield
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+# systemd stops the worker with SIGTERM, its shards are released below.
+signal.signal(signal.SIGTERM, terminate)
 
 try:
     while True:
-        nodeset.update_from_db(session)
+        scheduler.wait()
+        cycle_start = time.perf_counter()
+
+        # Only nodes, which the webserver has inserted or deleted, are
+        # loaded here. If the shards of this worker have changed, all
+        # nodes are loaded again.
+        with phase('load'):
+            shards = None
+            if sharded:
+                shards = WorkerLease.acquire(session, owner, args.shard, WORKER_SHARDS, WORKER_LEASE_SECONDS)
+                metrics.set('keepitup_worker_shards', len(shards))
+
+            if shards != nodeset.shards:
+                print("shards: " + ", ".join(str(shard) for shard in sorted(shards)))
+                nodeset.shards = shards
+                nodeset.update_from_db(session)
+            else:
+                nodeset.refresh(session)
 
         # Update last_seen_at from nodes.json...
-        nodes_json_cache = NodesJSONCache()
-        nodes_json_cache.update()
+        # Only the nodes in the db are of interest here, so all others are
+        # dropped while parsing. They are still published in the snapshot
+        # for the webserver.
+        # The download is aborted at its deadline, so a slow map server
+        # can not delay the check below.
+        # With several workers, only the owner of shard 0 publishes the
+        # snapshot.
+        with phase('fetch'):
+            publish = not sharded or 0 in nodeset.shards
+            changed = nodes_json_cache.update(filter_nodeids={n.nodeid for n in nodeset.nodes},
+                                              snapshot_path=NODES_SNAPSHOT_PATH if publish else None,
+                                              deadline=WORKER_PHASE_DEADLINES.get('fetch'))
+
+        if changed and WORKER_ALIGN_TO_UPSTREAM:
+            scheduler.align(parse_time(nodes_json_cache.timestamp).timestamp(), WORKER_UPSTREAM_DELAY)
 
-        for node in nodeset.nodes:
-            nodes_json_cache.update_db_node(node)
-            session.add(node)
+        if changed:
+            metrics.set('keepitup_nodes_json_bytes', nodes_json_cache.size, encoding='identity')
+            metrics.set('keepitup_nodes_json_bytes', nodes_json_cache.transfer_size, encoding='transfer')
+        for url, result in nodes_json_cache.results.items():
+            metrics.inc('keepitup_nodes_json_downloads_total', source=url, result=result)
 
-        session.commit()
+        # If the upstream timestamp did not move, the db is already up to
+        # date. The nodes are checked anyway, as their state also depends
+        # on the current time. Only the nodes, which have changed, are
+        # written.
+        if changed:
+            with phase('sync'):
+                written = nodeset.sync(session, nodes_json_cache)
+            metrics.set('keepitup_worker_nodes_written', written)
 
-        for n in nodeset.nodes:
-            alarm = n.check(session)
-            if alarm is None:
-                continue
+        # All nodes are checked at once, see NodeSet.check(). The mails are
+        # queued in the same transaction.
+        with phase('check'):
+            alarms = nodeset.check(session)
 
+        for alarm in alarms:
             if alarm.is_resolved:
-                print("node " + n.name + ": resolved")
+                print("node " + alarm.node.name + ": resolved")
             else:
-                print("node " + n.name + ": alarm")
+                print("node " + alarm.node.name + ": alarm")
+            metrics.inc('keepitup_worker_alarms_total', kind='resolved' if alarm.is_resolved else 'alarm')
+
+        with phase('availability'):
+            nodeset.record_availability(availability)
 
-        time.sleep(60)
+        metrics.observe('keepitup_worker_cycle_seconds', time.perf_counter() - cycle_start)
+        metrics.inc('keepitup_worker_cycles_total')
+        metrics.set('keepitup_worker_last_cycle_timestamp_seconds', time.time())
+        metrics.set('keepitup_worker_nodes', len(nodeset.nodes))
+        metrics.inc('keepitup_worker_nodes_processed_total', len(nodeset.nodes))
+        metrics.inc('keepitup_worker_mails_queued_total', nodeset.queued_mails)
+        metrics.publish()
 
 
 except KeyboardInterrupt:
     print("CTRL + C pressed. Exiting.")
+finally:
+    if sharded:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        session.rollback()
+        WorkerLease.release(session, owner)
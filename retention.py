@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+""" Folds the resolved alarms older than ALARM_RETENTION_DAYS into the
+AlarmRollups and gives the freed pages back to the file system. The finished
+days of the availability history are compacted, and the days older than
+AVAILABILITY_RETENTION_DAYS are deleted. Everything
+is done in small slices with a pause in between, so the worker and the
+webserver are never blocked for long. Run this once a day (see
+dist/keepitup-retention.timer).
+
+The freed pages are only returned with auto_vacuum=INCREMENTAL, which new
+dbs get by default. Older dbs have to be converted once with --convert,
+which rewrites the whole db (stop the other processes for this). """
+
+from main import *
+from availability import AvailabilityStore
+import argparse
+import time
+
+# Alarms, which are folded in one transaction.
+BATCH_SIZE = 500
+# Pages, which are returned in one transaction.
+VACUUM_PAGES = 256
+# Seconds to pause between the slices.
+PAUSE = 0.1
+
+
+def fold_alarms(session, before):
+    folded = 0
+    while True:
+        n = AlarmRollup.fold(session, before, BATCH_SIZE)
+        session.commit()
+        if n == 0:
+            return folded
+        folded += n
+        time.sleep(PAUSE)
+
+
+def incremental_vacuum(engine):
+    """ Returns the number of freed pages. """
+
+    freed = 0
+    with engine.connect() as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            print("warning: the db does not use auto_vacuum=INCREMENTAL, run retention.py --convert once", file=sys.stderr)
+            return 0
+
+        while True:
+            free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            conn.rollback()
+            if free == 0:
+                break
+
+            # sqlite3 only steps the pragma once (one page) in execute(),
+            # executescript() runs it to the end
+            conn.connection.driver_connection.executescript('PRAGMA incremental_vacuum(%d)' % VACUUM_PAGES)
+            freed += min(free, VACUUM_PAGES)
+            time.sleep(PAUSE)
+
+        # the file only shrinks, when the wal is written back. PASSIVE does
+        # not wait for the readers of the other processes.
+        conn.exec_driver_sql('PRAGMA wal_checkpoint(PASSIVE)')
+
+    return freed
+
+
+def compact_availability(store, today):
+    """ Returns the number of compacted and of deleted days. """
+
+    horizon = today - datetime.timedelta(days=AVAILABILITY_RETENTION_DAYS)
+    compacted = deleted = 0
+
+    for day in store.days():
+        if day < horizon:
+            store.delete_day(day)
+            deleted += 1
+        # the worker might still record the last minute of yesterday
+        elif day < today - datetime.timedelta(days=1) and store.compact_day(day):
+            compacted += 1
+            time.sleep(PAUSE)
+
+    return compacted, deleted
+
+
+def convert(engine):
+    with engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        # VACUUM can not run inside a transaction
+        conn.connection.driver_connection.isolation_level = None
+        conn.exec_driver_sql('VACUUM')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Folds old alarms and shrinks the db.")
+    parser.add_argument('--convert', action='store_true',
+                        help="switch the db to auto_vacuum=INCREMENTAL (rewrites the whole db)")
+    args = parser.parse_args()
+
+    engine = get_engine()
+
+    if args.convert:
+        convert(engine)
+        print("retention.py: converted the db to auto_vacuum=INCREMENTAL.")
+
+    session = get_session()
+    before = datetime.datetime.now() - datetime.timedelta(days=ALARM_RETENTION_DAYS)
+    folded = fold_alarms(session, before)
+    session.close()
+
+    freed = incremental_vacuum(engine)
+    print("retention.py: folded %d alarms, freed %d pages." % (folded, freed))
+
+    compacted, deleted = compact_availability(AvailabilityStore(AVAILABILITY_DIR), datetime.date.today())
+    print("retention.py: compacted %d, deleted %d days of the availability history." % (compacted, deleted))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+from contextlib import contextmanager
+
+
+class CycleScheduler:
+    """ Starts the cycles of the worker on fixed wall clock ticks: every
+    interval seconds, offset seconds past the full interval. Sleeping a fixed
+    time after every cycle instead would make the period drift by the
+    processing time.
+
+    If a cycle overruns one or more ticks, these are skipped: the next cycle
+    starts right away and covers all of them, nothing is queued up. """
+
+    def __init__(self, interval, offset=0, metrics=None, clock=time.time, sleep=time.sleep):
+        self.interval = interval
+        self.offset = offset % interval
+        self.metrics = metrics
+        self._clock = clock
+        self._sleep = sleep
+        self._due = None
+
+    def _next_tick(self, now):
+        return now - (now - self.offset) % self.interval + self.interval
+
+    def wait(self):
+        """ Sleeps until the next tick. The first call returns immediately.
+        Returns the number of ticks, which have been skipped. """
+
+        now = self._clock()
+        if self._due is None:
+            self._due = self._next_tick(now)
+            return 0
+
+        if now < self._due:
+            self._sleep(self._due - now)
+            self._due += self.interval
+            return 0
+
+        skipped = int((now - self._due) // self.interval) + 1
+        print("warning: worker cycle overran, skipped %d tick(s)" % skipped, file=sys.stderr)
+        if self.metrics:
+            self.metrics.inc('keepitup_worker_skipped_ticks_total', skipped)
+
+        self._due = self._next_tick(now)
+        return skipped
+
+    def align(self, timestamp, delay):
+        """ Moves the ticks to delay seconds after the given unix timestamp
+        (modulo the interval), e.g. after the time the nodes.json is
+        refreshed upstream. Small changes (< 1 s) are ignored. """
+
+        offset = (timestamp + delay) % self.interval
+        diff = abs(offset - self.offset)
+        if min(diff, self.interval - diff) < 1:
+            return
+
+        self.offset = offset
+        if self._due is not None:
+            self._due = self._next_tick(self._clock())
+
+    @contextmanager
+    def deadline(self, phase, seconds):
+        """ Logs, if the with block takes longer than seconds. """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            took = time.monotonic() - start
+            if seconds is not None and took > seconds:
+                print("warning: worker phase %s took %.1f s, deadline is %.1f s" % (phase, took, seconds), file=sys.stderr)
+                if self.metrics:
+                    self.metrics.inc('keepitup_worker_deadline_misses_total', phase=phase)
@@ -14,8 +14,11 @@ pip install -r requirements.txt
 (cd static; composer install)
 ./translate.sh compile
 
-# init db
-venv/bin/python -c 'from main import *; init_db();'
+# create the db or apply pending migrations
+venv/bin/python migrate.py
+
+# all processes publish their metrics here, see /metrics
+mkdir -p metrics
 
 if [ "$1" == '--systemwide' ]; then
 	if getent passwd ${SYSTEM_USER} > /dev/null 2>&1; then
@@ -25,7 +28,7 @@ if [ "$1" == '--systemwide' ]; then
 		echo User ${SYSTEM_USER} already created.
 	fi
 
-	for f in $DIR/dist/*.{service,target}; do
+	for f in $DIR/dist/*.{service,target,timer}; do
 		sudo cp "$f" "$SYSTEMD"
 		sudo sed -i "s\\%DIR%\\$DIR\\g" "$SYSTEMD"/$(basename "$f")
 		sudo sed -i "s\\%SYSTEM_USER%\\${SYSTEM_USER}\\g" "$SYSTEMD"/$(basename "$f")
@@ -41,7 +44,9 @@ if [ "$1" == '--systemwide' ]; then
 	fi
 
 	sudo systemctl enable keepitup-worker.service
+	sudo systemctl enable keepitup-mailer.service
 	sudo systemctl enable keepitup-webserver.service
+	sudo systemctl enable keepitup-retention.timer
 	sudo systemctl enable keepitup.target
 
 	sudo systemctl daemon-reload
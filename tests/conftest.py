@@ -0,0 +1,26 @@
+""" Every test gets a scratch database. config.py has to be importable, e.g.
+copy config.py.example and run:
+
+    venv/bin/python -m pytest tests """
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def session(tmp_path):
+    for engine in main._engines.values():
+        engine.dispose()
+    main._engines.clear()
+    main.SQLITE_URI = 'sqlite:///' + str(tmp_path / 'data.db')
+    main.init_db()
+
+    session = main.get_session()
+    yield session
+    session.close()
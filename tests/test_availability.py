@@ -0,0 +1,79 @@
+import datetime
+
+import numpy as np
+
+from availability import AvailabilityStore, MINUTES_PER_DAY, PLANE_SIZE
+
+DAY = datetime.datetime(2024, 6, 1)
+
+
+def test_only_recorded_nodes_are_observed(tmp_path):
+    # two workers, each recording the nodes of its own shard
+    store = AvailabilityStore(str(tmp_path))
+    at = DAY + datetime.timedelta(hours=1)
+    store.record(at, ['a', 'b'], ['a'])
+    store.record(at + datetime.timedelta(minutes=1), ['c'], ['c'])
+    store.record(at + datetime.timedelta(minutes=2), ['a', 'b'], ['a', 'b'])
+
+    start, end = at, at + datetime.timedelta(minutes=3)
+    assert store.availability('a', start, end) == 1
+    assert store.availability('b', start, end) == 0.5
+    # not observed by the first worker, so not down in that minute
+    assert store.availability('c', start, end) == 1
+    assert store.availability('unknown', start, end) is None
+
+
+def test_legacy_day_files(tmp_path):
+    store = AvailabilityStore(str(tmp_path))
+    # the slot is assigned, but the day was written by an older version
+    store.record(DAY - datetime.timedelta(days=1), ['a'], ['a'])
+    row = store.slots()['a'][0]
+
+    bits = np.zeros((row + 1, MINUTES_PER_DAY), dtype=bool)
+    bits[0, :60] = True
+    bits[row, :30] = True
+    (tmp_path / (DAY.date().isoformat() + '.bits')).write_bytes(np.packbits(bits, axis=1).tobytes())
+    assert len(np.packbits(bits, axis=1)[0]) == PLANE_SIZE
+
+    assert store.availability('a', DAY, DAY + datetime.timedelta(hours=2)) == 0.5
+
+
+def test_compact_day(tmp_path):
+    store = AvailabilityStore(str(tmp_path))
+    nodeids = ['node%d' % i for i in range(500)]
+    for minute in range(MINUTES_PER_DAY):
+        at = DAY + datetime.timedelta(minutes=minute)
+        # node0 is down every other hour, node1 is only observed in the morning
+        up = [nodeid for nodeid in nodeids if nodeid != 'node0' or at.hour % 2]
+        store.record(at, [nodeid for nodeid in nodeids if nodeid != 'node1' or at.hour < 12], up)
+    store.close()
+
+    start, end = DAY, DAY + datetime.timedelta(days=1)
+    before = {nodeid: store.read(nodeid, start, end) for nodeid in ['node0', 'node1', 'node2', 'unknown']}
+
+    assert store.compact_day(DAY.date())
+    assert not store.compact_day(DAY.date())
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['2024-06-01.runs', 'slots']
+    assert (tmp_path / '2024-06-01.runs').stat().st_size < 20 * (len(nodeids) + 1) + 2000
+
+    for nodeid, (covered, up) in before.items():
+        after = store.read(nodeid, start, end)
+        assert np.array_equal(covered, after[0]) and np.array_equal(up, after[1])
+    assert store.availability('node0', start, end) == 0.5
+    assert store.availability('node1', start, end) == 1
+
+
+def test_compact_legacy_day(tmp_path):
+    store = AvailabilityStore(str(tmp_path))
+    store.record(DAY - datetime.timedelta(days=1), ['a'], ['a'])
+    row = store.slots()['a'][0]
+
+    bits = np.zeros((row + 1, MINUTES_PER_DAY), dtype=bool)
+    bits[0, :60] = True
+    bits[row, :30] = True
+    (tmp_path / (DAY.date().isoformat() + '.bits')).write_bytes(np.packbits(bits, axis=1).tobytes())
+
+    assert store.days() == [(DAY - datetime.timedelta(days=1)).date(), DAY.date()]
+    assert store.compact_day(DAY.date())
+    assert not (tmp_path / (DAY.date().isoformat() + '.bits')).exists()
+    assert store.availability('a', DAY, DAY + datetime.timedelta(hours=2)) == 0.5
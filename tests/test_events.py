@@ -0,0 +1,80 @@
+import threading
+
+import webserver
+from main import Node, NodeEvent, Subscription, User
+
+
+def add_events(session, nodeids):
+    session.execute(NodeEvent.__table__.insert(), [{'nodeid': nodeid, 'data': '{}'} for nodeid in nodeids])
+    session.commit()
+
+
+def test_streams_over_the_limit_poll(session, monkeypatch):
+    broadcaster = webserver.EventBroadcaster(poll_interval=0.01)
+    monkeypatch.setattr(webserver, 'event_broadcaster', broadcaster)
+    assert broadcaster.start(5) == 0
+    add_events(session, ['a', 'b'])
+    with broadcaster._cond:
+        assert broadcaster._cond.wait_for(lambda: broadcaster.latest_id == 2, 5)
+
+    # all streams are taken
+    monkeypatch.setattr(webserver, 'event_streams', threading.BoundedSemaphore(1))
+    webserver.event_streams.acquire()
+
+    client = webserver.app.test_client()
+    body = client.get('/events?nodeid=a', headers={'Last-Event-ID': '0'}).get_data(as_text=True)
+
+    assert body.startswith('retry: %d\n\n' % webserver.EVENTS_RETRY_MS)
+    assert 'id: 1\nevent: node\n' in body
+    assert 'id: 2\nevent: node\n' not in body
+    assert body.endswith('id: 2\n\n')
+
+
+def test_events_of_the_subscriptions(session, monkeypatch):
+    user = User(email='user@example.com')
+    session.add_all([Subscription(user=user, node=Node('node-' + nodeid, nodeid)) for nodeid in ['a', 'b']])
+    session.commit()
+
+    broadcaster = webserver.EventBroadcaster(poll_interval=0.01)
+    monkeypatch.setattr(webserver, 'event_broadcaster', broadcaster)
+    assert broadcaster.start(5) == 0
+    add_events(session, ['a', 'b', 'c', 'd'])
+    with broadcaster._cond:
+        assert broadcaster._cond.wait_for(lambda: broadcaster.latest_id == 4, 5)
+
+    # only the pending events are sent
+    monkeypatch.setattr(webserver, 'event_streams', threading.BoundedSemaphore(1))
+    webserver.event_streams.acquire()
+
+    client = webserver.app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['email'] = user.email
+    body = client.get('/events?subscriptions=1&nodeid=c', headers={'Last-Event-ID': '0'}).get_data(as_text=True)
+
+    assert [line for line in body.split('\n') if line.startswith('id: ')] == ['id: 1', 'id: 2', 'id: 3', 'id: 4']
+    assert body.count('event: node') == 3
+    assert 'id: 4\nevent: node\n' not in body
+
+
+def test_first_poll_timeout(session, monkeypatch):
+    broadcaster = webserver.EventBroadcaster()
+    # the poll thread is blocked, e.g. by a locked db
+    broadcaster._thread = threading.Thread()
+    monkeypatch.setattr(webserver, 'event_broadcaster', broadcaster)
+    monkeypatch.setattr(webserver, 'EVENTS_START_SECONDS', 0.1)
+
+    client = webserver.app.test_client()
+    body = client.get('/events').get_data(as_text=True)
+
+    assert body == 'retry: %d\n\n' % webserver.EVENTS_RETRY_MS
+
+
+def test_stream_releases_its_slot(session, monkeypatch):
+    monkeypatch.setattr(webserver, 'event_broadcaster', webserver.EventBroadcaster(poll_interval=0.01))
+    monkeypatch.setattr(webserver, 'event_streams', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(webserver, 'EVENTS_STREAM_SECONDS', 0)
+
+    client = webserver.app.test_client()
+    for _ in range(2):
+        body = client.get('/events').get_data(as_text=True)
+        assert body == 'retry: 2000\n\nid: 0\n\n'
@@ -0,0 +1,69 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+from main import Alarm, Node, OutboxMail, Subscription, User
+import mail_sender
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg, to_addr):
+        self.sent += [(msg, to_addr)]
+
+    def close(self):
+        pass
+
+
+def drain(session, monkeypatch, tmp_path):
+    monkeypatch.setattr(mail_sender.metrics, 'directory', str(tmp_path))
+    connections = [FakeConnection(), FakeConnection()]
+    with ThreadPoolExecutor(2) as pool:
+        mail_sender.drain(session, pool, connections)
+    return [msg for conn in connections for msg, _ in conn.sent]
+
+
+def test_digest_over_several_cycles(session, monkeypatch, tmp_path):
+    """ The alarms of three worker cycles (60 s apart) within a digest window
+    of 300 s go out as a single digest, as soon as the first one is due. """
+
+    user = User(email='user@example.com', language='en')
+    nodes = [Node('node%d' % i, 'nodeid%d' % i) for i in range(3)]
+    session.add(user)
+    session.add_all(nodes)
+    session.add_all([Subscription(user=user, node=node) for node in nodes])
+    session.commit()
+
+    now = datetime.datetime.now()
+    for i, node in enumerate(nodes):
+        # The cycles were 301, 241 and 181 s ago, so only the mail of the
+        # first one is due yet.
+        monkeypatch.setattr(main, 'MAIL_DIGEST_WINDOW', 300 - (301 - 60 * i))
+        alarm = Alarm(node=node, alarm_at=now)
+        session.add(alarm)
+        assert alarm.queue_notification_mails(session) == 1
+        session.commit()
+
+    sent = drain(session, monkeypatch, tmp_path)
+
+    assert len(sent) == 1
+    assert all(node.name in sent[0].as_string() for node in nodes)
+    assert all(mail.sent_at is not None for mail in session.query(OutboxMail))
+
+
+def test_nothing_due(session, monkeypatch, tmp_path):
+    user = User(email='user@example.com', language='en')
+    node = Node('node', 'nodeid')
+    session.add_all([user, node, Subscription(user=user, node=node)])
+    session.commit()
+
+    monkeypatch.setattr(main, 'MAIL_DIGEST_WINDOW', 300)
+    alarm = Alarm(node=node, alarm_at=datetime.datetime.now())
+    session.add(alarm)
+    alarm.queue_notification_mails(session)
+    session.commit()
+
+    assert drain(session, monkeypatch, tmp_path) == []
@@ -0,0 +1,26 @@
+import json
+import os
+import threading
+
+import metrics
+
+
+def test_concurrent_publish(tmp_path):
+    m = metrics.Metrics(str(tmp_path), 'test')
+
+    def work():
+        for _ in range(50):
+            m.inc('keepitup_http_requests_total', endpoint='index', status=200)
+            m.publish()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert os.listdir(str(tmp_path)) == ['test.json']
+    with open(m.path) as f:
+        values = json.load(f)['values']
+    # the last publish has seen all increments
+    assert values == [['keepitup_http_requests_total', {'endpoint': 'index', 'status': 200}, 400]]
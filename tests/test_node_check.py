@@ -0,0 +1,128 @@
+import datetime
+
+import main
+from main import Alarm, NODE_OFFLINE_TIMEOUT, NODE_UNKNOWN_TIMEOUT, Node, NodeSet, OutboxMail, Subscription, User
+
+MINUTE = datetime.timedelta(minutes=1)
+
+
+def add_node(session, state, last_seen_at, last_updated_at, is_state_unknown=False):
+    node = Node('node', 'nodeid')
+    node.state = state
+    node.is_state_unknown = is_state_unknown
+    node.last_seen_at = last_seen_at
+    node.last_updated_at = last_updated_at
+    session.add(node)
+    session.commit()
+    return node
+
+
+def check(session):
+    nodeset = NodeSet()
+    nodeset.update_from_db(session)
+    alarms = nodeset.check(session)
+    session.expire_all()
+    return alarms
+
+
+def test_new_to_ok(session):
+    now = datetime.datetime.now()
+    node = add_node(session, 'new', now, now, is_state_unknown=True)
+
+    assert check(session) == []
+
+    assert (node.state, node.is_state_unknown) == ('ok', False)
+    assert session.query(Alarm).count() == 0
+
+
+def test_new_to_problem(session):
+    now = datetime.datetime.now()
+    node = add_node(session, 'new', now - 2 * NODE_OFFLINE_TIMEOUT, now)
+
+    alarms = check(session)
+
+    assert node.state == 'problem'
+    assert len(alarms) == 1
+    # the node has never been seen online, so the alarm starts now
+    assert now <= alarms[0].alarm_at <= datetime.datetime.now()
+    assert alarms[0].resolved_at is None
+
+
+def test_ok_to_problem(session):
+    now = datetime.datetime.now()
+    last_seen_at = now - 2 * NODE_OFFLINE_TIMEOUT
+    user = User(email='user@example.com')
+    node = add_node(session, 'ok', last_seen_at, now)
+    session.add(Subscription(user=user, node=node))
+    session.commit()
+
+    alarms = check(session)
+
+    assert node.state == 'problem'
+    assert [(a.node_id, a.alarm_at, a.resolved_at) for a in alarms] == [(node.id, last_seen_at, None)]
+    assert [(m.user_id, m.kind) for m in session.query(OutboxMail)] == [(user.id, 'alarm')]
+
+
+def test_problem_to_ok_resolves_the_latest_alarm(session):
+    now = datetime.datetime.now()
+    node = add_node(session, 'problem', now - MINUTE, now)
+    old = Alarm(node=node, alarm_at=now - 10 * NODE_OFFLINE_TIMEOUT, resolved_at=now - 9 * NODE_OFFLINE_TIMEOUT)
+    latest = Alarm(node=node, alarm_at=now - 2 * NODE_OFFLINE_TIMEOUT)
+    session.add_all([old, latest])
+    session.commit()
+
+    alarms = check(session)
+
+    assert node.state == 'ok'
+    assert alarms == [latest]
+    assert latest.resolved_at == now - MINUTE
+    assert old.resolved_at == now - 9 * NODE_OFFLINE_TIMEOUT
+
+
+def test_never_seen_node_is_unknown(session):
+    now = datetime.datetime.now()
+    node = add_node(session, 'new', None, now)
+
+    assert check(session) == []
+
+    assert (node.state, node.is_state_unknown) == ('new', True)
+
+
+def test_unknown_keeps_the_old_state(session):
+    # the nodes.json has not been updated for a while, so the node is not
+    # seen anymore, but it is not offline either
+    now = datetime.datetime.now()
+    node = add_node(session, 'ok', now - 2 * NODE_OFFLINE_TIMEOUT, now - 2 * NODE_UNKNOWN_TIMEOUT)
+
+    assert check(session) == []
+
+    assert (node.state, node.is_state_unknown) == ('ok', True)
+    assert session.query(Alarm).count() == 0
+
+    # once the nodes.json is updated again, the state switches
+    node.last_updated_at = now
+    session.commit()
+    assert len(check(session)) == 1
+    assert (node.state, node.is_state_unknown) == ('problem', False)
+
+
+def test_state_switched_by_another_worker(session):
+    now = datetime.datetime.now()
+    add_node(session, 'ok', now - 2 * NODE_OFFLINE_TIMEOUT, now)
+
+    nodeset = NodeSet()
+    nodeset.update_from_db(session)
+
+    # Another worker (e.g. while the shard moved) switches the node in the
+    # meantime and creates the alarm.
+    other = main.get_session()
+    other_nodeset = NodeSet()
+    other_nodeset.update_from_db(other)
+    assert len(other_nodeset.check(other)) == 1
+    other.close()
+
+    assert nodeset.check(session) == []
+
+    session.expire_all()
+    assert session.query(Alarm).count() == 1
+    assert nodeset.nodes[0].state == 'problem'
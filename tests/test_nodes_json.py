@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from main import NodesJSONCache
+from nodes_json import NodeSearchIndex, NodesSnapshot
+from bench.server import NodesJSONServer
+
+NODES_JSON = json.dumps({
+    'timestamp': '2024-06-01T12:00:00+0000',
+    'version': 2,
+    'nodes': [{'lastseen': '2024-06-01T12:00:00+0000', 'nodeinfo': {'node_id': 'nodeid', 'hostname': 'host'}}],
+}).encode('utf-8')
+
+
+@pytest.fixture
+def trickling_url():
+    """ A server, which sends the nodes.json one byte at a time, so no read
+    ever times out. """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(NODES_JSON)))
+            self.end_headers()
+            for i in range(len(NODES_JSON)):
+                time.sleep(0.05)
+                try:
+                    self.wfile.write(NODES_JSON[i:i + 1])
+                    self.wfile.flush()
+                except OSError:
+                    return
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d/nodes.json' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_deadline_of_a_trickling_source(trickling_url):
+    cache = NodesJSONCache(trickling_url)
+
+    started = time.monotonic()
+    assert not cache.update(deadline=0.5)
+
+    assert time.monotonic() - started < 2
+    assert cache.results == {trickling_url: 'failed'}
+
+
+def test_trickling_source_does_not_hold_up_the_others(trickling_url):
+    with NodesJSONServer() as server:
+        server.publish(NODES_JSON)
+        cache = NodesJSONCache([trickling_url, server.url])
+
+        # every abandoned download would keep one of the threads
+        for _ in range(5):
+            started = time.monotonic()
+            cache.update(deadline=0.5)
+
+            assert time.monotonic() - started < 2
+            assert cache.results[trickling_url] == 'failed'
+            # the download is conditional after the first one
+            assert cache.results[server.url] in ('modified', 'unchanged')
+            assert [n.nodeid for n in cache.nodes] == ['nodeid']
+
+
+def nodes_json(timestamp, nodes):
+    return json.dumps({
+        'timestamp': timestamp,
+        'version': 2,
+        'nodes': [{'lastseen': lastseen, 'nodeinfo': {'node_id': nodeid, 'hostname': hostname}}
+                  for nodeid, hostname, lastseen in nodes],
+    }).encode('utf-8')
+
+
+def test_snapshot_of_all_sources(tmp_path):
+    snapshot_path = str(tmp_path / 'nodes.snapshot')
+    with NodesJSONServer() as first, NodesJSONServer() as second:
+        first.publish(nodes_json('2024-06-01T12:00:00+0000', [
+            ('a', 'a-old', '2024-06-01T11:00:00+0000'),
+            ('b', 'b', '2024-06-01T12:00:00+0000'),
+        ]))
+        second.publish(nodes_json('2024-06-01T12:00:00+0000', [
+            ('a', 'a-new', '2024-06-01T11:30:00+0000'),
+            ('c', 'c', None),
+        ]))
+        cache = NodesJSONCache([first.url, second.url])
+
+        assert cache.update(filter_nodeids={'b'}, snapshot_path=snapshot_path)
+        assert [n.nodeid for n in cache.nodes] == ['b']
+
+        # only the first source is modified, the nodes of the second one
+        # are still in the snapshot
+        first.publish(nodes_json('2024-06-01T12:01:00+0000', [
+            ('a', 'a-old', '2024-06-01T11:00:00+0000'),
+            ('b', 'b', '2024-06-01T12:01:00+0000'),
+            ('d', 'd', '2024-06-01T12:01:00+0000'),
+        ]))
+        assert cache.update(filter_nodeids={'b'}, snapshot_path=snapshot_path)
+        assert cache.results == {first.url: 'modified', second.url: 'unchanged'}
+
+    assert list(NodesSnapshot(snapshot_path)) == [
+        ('a', 'a-new', '2024-06-01T11:30:00+0000'),
+        ('b', 'b', '2024-06-01T12:01:00+0000'),
+        ('c', 'c', None),
+        ('d', 'd', '2024-06-01T12:01:00+0000'),
+    ]
+    # only the filtered nodes are kept in memory
+    assert [[record[0] for record in source.records] for source in cache.sources] == [['b'], []]
+
+
+SEARCH_NODES = [
+    ('c0ffee000001', 'Kaffee-Kueche'),
+    ('beef00000002', 'Bar-Kaffee'),
+    ('kaffee000003', 'Zentrale'),
+    ('000004kaffee', 'Ahornweg'),
+    ('a00000000005', 'kaffeemaschine'),
+    ('a00000000006', None),
+]
+
+
+def test_search_ranking():
+    index = NodeSearchIndex(SEARCH_NODES)
+
+    # hostname prefix, nodeid prefix, hostname substring, nodeid substring
+    assert index.search('KAFFEE ') == ([
+        ('c0ffee000001', 'Kaffee-Kueche'),
+        ('a00000000005', 'kaffeemaschine'),
+        ('kaffee000003', 'Zentrale'),
+        ('beef00000002', 'Bar-Kaffee'),
+        ('000004kaffee', 'Ahornweg'),
+    ], False)
+    # only in the middle of a nodeid
+    assert index.search('0004kaf') == ([('000004kaffee', 'Ahornweg')], False)
+    assert index.search('a0000000000') == ([('a00000000006', ''), ('a00000000005', 'kaffeemaschine')], False)
+    assert index.search('nothing') == ([], False)
+
+
+def test_search_returns_every_node_once():
+    # matches the hostname and the nodeid as prefix and as substring
+    index = NodeSearchIndex([('abcabc', 'abcabc'), ('xabc', 'abc-x')])
+
+    assert index.search('abc') == ([('xabc', 'abc-x'), ('abcabc', 'abcabc')], False)
+
+
+def test_search_pages():
+    index = NodeSearchIndex(SEARCH_NODES)
+    everything, more = index.search('', limit=len(SEARCH_NODES))
+    assert not more
+    assert len(everything) == len(SEARCH_NODES)
+
+    pages = []
+    offset = 0
+    while True:
+        results, more = index.search('', offset=offset, limit=4)
+        pages += [results]
+        offset += len(results)
+        if not more:
+            break
+
+    assert [len(page) for page in pages] == [4, 2]
+    assert [node for page in pages for node in page] == everything
+
+    ranked, _ = index.search('kaffee')
+    assert index.search('kaffee', offset=1, limit=2) == (ranked[1:3], True)
+    assert index.search('kaffee', offset=3, limit=2) == (ranked[3:5], False)
+    assert index.search('kaffee', offset=5, limit=2) == ([], False)
@@ -0,0 +1,11 @@
+import check_query_plans
+
+
+def test_query_plans(session):
+    check_query_plans.populate(session)
+
+    failures = {name: [(tables, ' '.join(statement.split())) for tables, statement, _ in failures]
+                for name, failures in check_query_plans.run_checks(session)}
+
+    assert {name: f for name, f in failures.items() if f} == {}
+    session.rollback()
@@ -0,0 +1,89 @@
+import datetime
+
+from main import Alarm, AlarmRollup, Node, OutboxMail, Subscription, User, text
+import retention
+from availability import AvailabilityStore
+
+retention.PAUSE = 0
+
+NOW = datetime.datetime(2024, 6, 1, 12)
+OLD = NOW - datetime.timedelta(days=200)
+
+
+def add_alarm(session, node, user, alarm_at, minutes=30):
+    alarm = Alarm(node=node, alarm_at=alarm_at, resolved_at=alarm_at + datetime.timedelta(minutes=minutes))
+    session.add(alarm)
+    session.add(OutboxMail(user=user, alarm=alarm, kind='alarm'))
+    return alarm
+
+
+def test_fold_alarms(session):
+    user = User(email='user@example.com')
+    node = Node('node', 'nodeid')
+    session.add_all([user, node])
+    add_alarm(session, node, user, OLD)
+    add_alarm(session, node, user, OLD + datetime.timedelta(hours=1))
+    recent = add_alarm(session, node, user, NOW - datetime.timedelta(days=1))
+    session.commit()
+
+    assert retention.fold_alarms(session, NOW - datetime.timedelta(days=90)) == 2
+
+    assert session.query(Alarm).all() == [recent]
+    assert session.query(OutboxMail).count() == 1
+    count, downtime = AlarmRollup.totals(session, node)
+    assert count == 2
+    assert abs(downtime - 3600) < 1
+
+
+def test_fold_alarms_of_deleted_nodes(session):
+    # Older versions kept the alarms of deleted nodes with node_id NULL.
+    user = User(email='user@example.com')
+    node = Node('node', 'nodeid')
+    orphan = Node('orphan', 'orphan-nodeid')
+    session.add_all([user, node, orphan])
+    add_alarm(session, orphan, user, OLD)
+    add_alarm(session, orphan, user, NOW)
+    add_alarm(session, node, user, OLD)
+    session.commit()
+    session.execute(text('UPDATE alarms SET node_id = NULL WHERE node_id = :id'), {'id': orphan.id})
+    session.commit()
+
+    assert retention.fold_alarms(session, NOW - datetime.timedelta(days=90)) == 3
+
+    assert session.query(Alarm).count() == 0
+    assert session.query(OutboxMail).count() == 0
+    assert [(r.node_id, r.count) for r in session.query(AlarmRollup)] == [(node.id, 1)]
+
+
+def test_node_delete(session):
+    user = User(email='user@example.com')
+    node = Node('node', 'nodeid')
+    session.add_all([user, node, Subscription(user=user, node=node)])
+    add_alarm(session, node, user, OLD)
+    add_alarm(session, node, user, NOW)
+    session.commit()
+    retention.fold_alarms(session, NOW - datetime.timedelta(days=90))
+
+    # as in webserver.unsubscribe()
+    session.delete(node.subscriptions[0])
+    session.commit()
+    node.delete(session)
+    session.commit()
+
+    assert session.query(Node).count() == 0
+    assert session.query(Alarm).count() == 0
+    assert session.query(OutboxMail).count() == 0
+    assert session.query(AlarmRollup).count() == 0
+
+
+def test_compact_availability(tmp_path):
+    store = AvailabilityStore(str(tmp_path))
+    today = NOW.date()
+    for days in [retention.AVAILABILITY_RETENTION_DAYS + 1, 2, 1, 0]:
+        store.record(NOW - datetime.timedelta(days=days), ['a'], ['a'])
+
+    assert retention.compact_availability(store, today) == (1, 1)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['2024-05-30.runs', '2024-05-31.avail', '2024-06-01.avail', 'slots']
+    assert store.availability('a', NOW - datetime.timedelta(days=2, minutes=1), NOW) == 1
@@ -0,0 +1,18 @@
+from sqlalchemy import select
+
+from main import Node, RoutingSession
+
+
+def test_flushes_go_to_the_readwrite_engine(session):
+    db = RoutingSession()
+    node = Node('node1', 'nodeid1')
+    db.add(node)
+    db.commit()
+
+    node.name = 'renamed'
+    # the autoflush of the query writes the change
+    db.execute(select(Node.id).where(Node.nodeid == 'nodeid2')).all()
+    db.commit()
+    db.close()
+
+    assert session.execute(select(Node.name)).scalars().all() == ['renamed']
@@ -0,0 +1,18 @@
+import webserver
+from main import DataVersion, Node
+
+
+def test_older_version_is_not_cached(session, monkeypatch):
+    session.add(Node('node1', 'nodeid1'))
+    session.commit()
+    version = DataVersion.get(session)
+    monkeypatch.setattr(webserver, '_sidebar_cache', {'version': None, 'nodes': None, 'nodeids': None, 'users': {}})
+
+    assert webserver.get_sidebar(session, None)['nodeids'] == {'nodeid1'}
+    cache = webserver._sidebar_cache
+    assert cache['version'] == version
+
+    # a request, which has read the version before the last change
+    monkeypatch.setattr(DataVersion, 'get', classmethod(lambda cls, session: version - 1))
+    assert webserver.get_sidebar(session, None)['nodeids'] == {'nodeid1'}
+    assert webserver._sidebar_cache is cache
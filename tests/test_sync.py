@@ -0,0 +1,53 @@
+import datetime
+import json
+
+import main
+from main import Node, NodesJSONCache, NodeSet
+from bench.server import NodesJSONServer
+
+START = datetime.datetime(2024, 6, 1, 12, tzinfo=datetime.timezone.utc)
+
+
+def nodes_json(now, lastseen):
+    def fmt(t):
+        return t.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    nodes = [{'lastseen': fmt(seen), 'nodeinfo': {'node_id': nodeid, 'hostname': 'host-' + nodeid}}
+             for nodeid, seen in lastseen.items()]
+    return json.dumps({'timestamp': fmt(now), 'version': 2, 'nodes': nodes}).encode('utf-8')
+
+
+def test_sync_only_writes_the_changed_nodes(session):
+    lastseen = {'nodeid%d' % i: START for i in range(200)}
+    session.add_all([Node('host-' + nodeid, nodeid) for nodeid in lastseen])
+    session.commit()
+
+    # the session of the worker, see ping_worker.py
+    worker_session = main.get_session(expire_on_commit=False)
+    nodeset = NodeSet()
+    nodeset.update_from_db(worker_session)
+
+    with NodesJSONServer() as server:
+        cache = NodesJSONCache(server.url)
+        server.publish(nodes_json(START, lastseen))
+        cache.update(filter_nodeids={n.nodeid for n in nodeset.nodes})
+        assert nodeset.sync(worker_session, cache) == 200
+
+        for cycle in range(1, 4):
+            now = START + datetime.timedelta(minutes=cycle)
+            # only a few nodes are seen again
+            for i in range(2):
+                lastseen['nodeid%d' % (cycle * 10 + i)] = now
+            server.publish(nodes_json(now, lastseen))
+
+            assert cache.update(filter_nodeids={n.nodeid for n in nodeset.nodes})
+            assert nodeset.sync(worker_session, cache) == 2
+
+    worker_session.close()
+
+    # all nodes are fresh nevertheless
+    session.expire_all()
+    nodes = {node.nodeid: node for node in session.query(Node)}
+    assert {node.last_updated_at for node in nodes.values()} == {now.replace(tzinfo=None)}
+    assert nodes['nodeid30'].last_seen_at == now.replace(tzinfo=None)
+    assert nodes['nodeid0'].last_seen_at == START.replace(tzinfo=None)
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
-from flask import Flask, session, render_template, abort, request, flash, url_for, redirect, g
+from flask import Flask, session, render_template, abort, request, flash, url_for, redirect, g, Response, jsonify, stream_with_context, has_request_context
 from main import *
-import dns.resolver
 from config import *
-from flask_sqlalchemy import SQLAlchemy
 from flask_babel import Babel, gettext
+from sqlalchemy.orm import scoped_session
+from collections import namedtuple
+from metrics import Metrics, collect as collect_metrics
+from nodes_json import NodeSearchIndex, open_search_index
+import functools
+import json
+import threading
+import time
+from collections import deque
+import hashlib
 
 
 def get_locale():
@@ -17,20 +25,95 @@ def get_locale():
 
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET_KEY
-# This is necessary, since sqlalchemy-flask seems to
-# expect things in a subfolder called "instance" normally now.
-SQLITE_URI = 'sqlite:///'+ app.root_path + '/data.db'
-app.config['SQLALCHEMY_DATABASE_URI'] = SQLITE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['BABEL_DEFAULT_LOCALE'] = 'en'
 babel = Babel(app, locale_selector=get_locale)
 
-sqlalchemy = SQLAlchemy(app)
+# One session per request. Reads go to the readonly connection pool, see
+# RoutingSession.
+db_session = scoped_session(sessionmaker(class_=RoutingSession))
 
 
 def get_db():
-    global sqlalchemy
-    return sqlalchemy.session
+    return db_session
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    db_session.remove()
+
+# Every gunicorn worker publishes its own file, they are merged in /metrics.
+metrics = Metrics(METRICS_DIR, 'web-{pid}')
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+
+for readonly in [False, True]:
+    event.listen(get_engine(readonly), 'before_cursor_execute', count_query)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'none'
+    metrics.inc('keepitup_http_requests_total', endpoint=endpoint, status=response.status_code)
+    metrics.observe('keepitup_http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+    metrics.observe('keepitup_http_sql_queries', g.get('sql_queries', 0), endpoint=endpoint)
+    metrics.publish(min_interval=1)
+    return response
+
+def page_etag(per_cycle=False):
+    """ Returns a weak etag for the current page, or None if the page must
+    not be cached. It is built from the DataVersion (which covers the nodes
+    and the subscriptions, see _VERSIONED_ATTRIBUTES), the logged in user
+    and the locale, so it can be computed with a single query. Pages, which
+    also show data that changes every worker cycle (like the availability),
+    pass per_cycle=True. """
+
+    # A pending flash message is shown only once, so neither the page
+    # showing it nor the next one may be served from the browser cache.
+    if '_flashes' in session:
+        return None
+
+    parts = [request.full_path, DataVersion.get(get_db()), session.get('email', ''), get_locale()]
+    if per_cycle:
+        parts += [int(time.time() // WORKER_INTERVAL)]
+
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def conditional_page(per_cycle=False):
+    """ Answers GET requests for the decorated page with 304 Not Modified,
+    if the etag sent in If-None-Match is still valid. Then, neither the
+    template is rendered nor any orm object is loaded. """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method == 'GET':
+                g.etag = page_etag(per_cycle)
+                if g.etag is not None and request.if_none_match.contains_weak(g.etag):
+                    response = Response(status=304)
+                    response.set_etag(g.etag, weak=True)
+                    return response
+
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@app.after_request
+def set_page_etag(response):
+    etag = g.get('etag')
+    if etag is not None and response.status_code == 200 and '_flashes' not in session:
+        response.set_etag(etag, weak=True)
+        # the browser has to revalidate every time, which is cheap
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    metrics.publish()
+    return Response(collect_metrics(METRICS_DIR), mimetype='text/plain; version=0.0.4')
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -38,16 +121,15 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 @app.route('/')
+@conditional_page()
 def hello_world():
     return render_template("index.html")
 
 @app.route('/node/<nodeid>')
+@conditional_page(per_cycle=True)
 def node(nodeid):
     db = get_db()
-    nodeset = NodeSet()
-    nodeset.update_from_db(db)
-
-    node = nodeset.find_by_nodeid(nodeid)
+    node = Node.find_by_nodeid(db, nodeid)
 
     if not node:
         flash('Error: Node with nodeid ' + nodeid + " not found!", 'danger')
@@ -57,8 +139,21 @@ def node(nodeid):
 
     subscription = node.get_subscription_by_user(db, get_user())
 
+    alarms, next_before = node.alarm_page(db, before=request.args.get('before', type=int))
+    # the older alarms are only kept as rollups, see retention.py
+    rollup_count, rollup_downtime = AlarmRollup.totals(db, node) if not next_before else (0, 0)
+
+    # numpy is only loaded with the first node page
+    from availability import AvailabilityStore
+    store = AvailabilityStore(AVAILABILITY_DIR)
+    availability = [(days, store.availability(node.nodeid, now - datetime.timedelta(days=days), now))
+                    for days in [1, 7, 30]]
+
     return render_template("node.html", node=node, now=now,
-                           NODE_LINKS=NODE_LINKS, subscription=subscription)
+                           NODE_LINKS=NODE_LINKS, subscription=subscription,
+                           alarms=alarms, next_before=next_before,
+                           rollup_count=rollup_count, rollup_downtime=format_duration(rollup_downtime),
+                           availability=availability)
 
 @app.route('/node/<nodeid>/toggle_notifications')
 def toggle_notifications(nodeid):
@@ -105,6 +200,8 @@ def register():
             return res(400)
 
         domain = email.rsplit('@', 1)[-1]
+        # only needed here, so it is not loaded on every worker boot
+        import dns.resolver
         try:
             dns.resolver.query(domain, 'MX')
         except dns.resolver.Timeout:
@@ -124,7 +221,7 @@ def register():
             user.send_confirm_mail(url_for('login', _external=True))
             return res(200)
 
-        user = User(email=email)
+        user = User(email=email, language=get_locale())
         db.add(user)
         db.commit()
         user.send_confirm_mail(url_for('login', _external=True))
@@ -134,6 +231,10 @@ def register():
     return res(200)
 
 def get_user():
+    # the user is looked up only once per request
+    if 'user' in g:
+        return g.user
+
     db = get_db()
     email = session.get('email', None)
     user = None
@@ -141,16 +242,66 @@ def get_user():
     if email:
         user = User.find_by_email(db, email)
 
+    g.user = user
     return user
 
+SidebarNode = namedtuple('SidebarNode', ['nodeid', 'name', 'constitution'])
+SidebarSubscription = namedtuple('SidebarSubscription', ['node', 'send_notifications'])
+
+# The sidebar data is cached per process, until the DataVersion changes. The
+# requests of all threads share the cache, which is replaced as a whole.
+_sidebar_cache = {'version': None, 'nodes': None, 'nodeids': None, 'users': {}}
+_sidebar_lock = threading.Lock()
+
+def get_sidebar(db, user):
+    global _sidebar_cache
+
+    # The version is read before the data, so the data in the cache is never
+    # older than the version it is cached for.
+    version = DataVersion.get(db)
+    with _sidebar_lock:
+        cache = _sidebar_cache
+        if cache['version'] is None or version > cache['version']:
+            cache = _sidebar_cache = {'version': version, 'nodes': None, 'nodeids': None, 'users': {}}
+        elif version < cache['version']:
+            # another thread has already seen a newer version
+            cache = {'version': version, 'nodes': None, 'nodeids': None, 'users': {}}
+
+    if cache['nodes'] is None:
+        rows = db.execute(select(Node.id, Node.nodeid, Node.name, Node.state, Node.is_state_unknown).
+                          order_by(Node.name))
+        # see Node.constitution
+        nodes = {id: SidebarNode(nodeid, name, 'unknown' if is_state_unknown else state)
+                 for id, nodeid, name, state, is_state_unknown in rows}
+        cache['nodeids'] = {node.nodeid for node in nodes.values()}
+        cache['nodes'] = nodes
+
+    nodes = cache['nodes']
+    sidebar = {'nodes': list(nodes.values()), 'nodeids': cache['nodeids'],
+               'subscriptions': [], 'subscribed_nodeids': set()}
+
+    if user is None:
+        return sidebar
+
+    if user.id not in cache['users']:
+        rows = db.execute(select(Subscription.node_id, Subscription.send_notifications).
+                          where(Subscription.user_id == user.id))
+        subscriptions = sorted((SidebarSubscription(nodes[node_id], send_notifications)
+                                for node_id, send_notifications in rows if node_id in nodes),
+                               key=lambda s: s.node.name)
+        cache['users'][user.id] = subscriptions
+
+    subscriptions = cache['users'][user.id]
+    sidebar['subscriptions'] = subscriptions
+    sidebar['subscribed_nodeids'] = {s.node.nodeid for s in subscriptions}
+    return sidebar
+
 @app.context_processor
 def inject_stuff():
     db = get_db()
+    user = get_user()
 
-    nodeset = NodeSet()
-    nodeset.update_from_db(db)
-
-    return dict(node_list=nodeset, user=get_user(), np=np)
+    return dict(sidebar=get_sidebar(db, user), user=user, events_max_nodeids=EVENTS_MAX_NODEIDS)
 
 @app.template_filter('show_constitution')
 def show_constitution(node):
@@ -161,7 +312,8 @@ def show_constitution(node):
     else:
         css_class = 'text-muted'
 
-    return '<span class="%s">%s</span>' % (css_class, node.constitution)
+    # data-constitution-of is used to update the constitution live, see layout.html
+    return '<span class="%s" data-constitution-of="%s">%s</span>' % (css_class, node.nodeid, node.constitution)
 
 @app.route('/login')
 def login():
@@ -189,6 +341,10 @@ def login():
         flash(gettext('Error: The supplied token is invalid.'), 'danger')
         return res(400)
 
+    # The worker uses the stored language for the notification mails.
+    user.language = get_locale()
+    db.commit()
+
     session['email'] = user.email
 
     flash(gettext('Success: Email confirmed. You are now logged in.'), 'success')
@@ -219,7 +375,11 @@ def subscribe():
         return redirect('/')
 
     def res(code):
-        return render_template("subscribe.html", nodes_json_cache=nodes_json_cache), code
+        return render_template("subscribe.html"), code
+
+    if "nodeid" not in request.args:
+        # The list of nodes is loaded page by page from subscribe_search().
+        return subscribe_page()
 
     def try_subscribe(node):
         if user in node.subscribed_users:
@@ -248,25 +408,291 @@ def subscribe():
     # First, we try to query the nodeset. By chance, someone is already
     # subscribed to this node. This is usually faster than loading the
     # nodes.json.
-    if "nodeid" in request.args:
-        node = nodeset.find_by_nodeid(request.args['nodeid'])
+    node = nodeset.find_by_nodeid(request.args['nodeid'])
 
-        if node:
-            return try_subscribe(node)
+    if node:
+        return try_subscribe(node)
 
     nodes_json_cache = NodesJSONCache()
-    nodes_json_cache.update(nodeset)
 
-    if "nodeid" in request.args:
-        node = nodes_json_cache.find_by_nodeid(request.args['nodeid'])
+    # Only the requested node is decoded from the snapshot.
+    load_nodes_json(nodes_json_cache, nodeset, filter_nodeids=[request.args['nodeid']])
+    node = nodes_json_cache.find_by_nodeid(request.args['nodeid'])
 
-        if not node:
-            flash(gettext('Error: Node with nodeid %(nodeid)s not found!', nodeid=request.args['nodeid']), 'danger')
-            return res(400)
+    if not node:
+        flash(gettext('Error: Node with nodeid %(nodeid)s not found!', nodeid=request.args['nodeid']), 'danger')
+        return res(400)
 
-        return try_subscribe(node)
+    return try_subscribe(node)
 
-    return res(200)
+@conditional_page()
+def subscribe_page():
+    return render_template("subscribe.html")
+
+# Maximum number of nodes returned by subscribe_search() at once.
+SEARCH_MAX_LIMIT = 200
+
+# Index built from a downloaded nodes.json, if there is no snapshot.
+_downloaded_search_index = {'index': None, 'loaded_at': 0}
+
+def get_search_index():
+    index = open_search_index(NODES_SNAPSHOT_PATH)
+    if index is not None:
+        return index
+
+    cached = _downloaded_search_index
+    if cached['index'] is None or time.monotonic() - cached['loaded_at'] > WORKER_INTERVAL:
+        nodes_json_cache = NodesJSONCache()
+        if not nodes_json_cache.update():
+            return NodeSearchIndex([])
+
+        cached['index'] = NodeSearchIndex((node.nodeid, node.name) for node in nodes_json_cache.nodes)
+        cached['loaded_at'] = time.monotonic()
+
+    return cached['index']
+
+@app.route('/subscribe/search')
+def subscribe_search():
+    """ Returns one page of the nodes matching the query q as json, for the
+    subscribe page. No orm objects are loaded: the nodes come from the
+    search index and the flags from the cached sidebar. """
+
+    user = get_user()
+    if not user:
+        return jsonify(error='not logged in'), 403
+
+    query = request.args.get('q', '')
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), SEARCH_MAX_LIMIT)
+
+    results, more = get_search_index().search(query, offset, limit)
+    sidebar = get_sidebar(get_db(), user)
+
+    return jsonify(
+        query=query,
+        nodes=[{'nodeid': nodeid,
+                'name': name,
+                'subscribed': nodeid in sidebar['subscribed_nodeids'],
+                'in_db': nodeid in sidebar['nodeids']}
+               for nodeid, name in results],
+        next_offset=offset + len(results) if more else None,
+    )
+
+def load_nodes_json(nodes_json_cache, nodeset, filter_nodeids=None):
+    # The worker publishes a snapshot of the nodes.json every cycle. Only if
+    # there is none (e.g. the worker has not run yet), the nodes.json is
+    # downloaded here.
+    if not nodes_json_cache.load_snapshot(NODES_SNAPSHOT_PATH, nodeset, filter_nodeids):
+        nodes_json_cache.update(nodeset, filter_nodeids=filter_nodeids)
+
+# Maximum number of nodeids in a single request to api_nodes().
+API_MAX_NODEIDS = 1000
+# Rows, which are serialized and sent at once by api_nodes().
+API_CHUNK_ROWS = 500
+CONSTITUTIONS = ['new', 'ok', 'problem', 'unknown']
+
+def json_time(t):
+    return t.isoformat() if t is not None else None
+
+@app.route('/api/nodes', methods=['GET', 'POST'])
+def api_nodes():
+    """ Returns the status of many nodes at once as json, for dashboards and
+    other tools. The nodes are selected by their nodeids (repeated or comma
+    separated "nodeid" parameters, which can also be posted as a form) or
+    by their constitution. The response is streamed. """
+
+    nodeids = None
+    if 'nodeid' in request.values:
+        nodeids = {nodeid for value in request.values.getlist('nodeid')
+                   for nodeid in value.split(',') if nodeid}
+        if len(nodeids) > API_MAX_NODEIDS:
+            return jsonify(error='at most %d nodeids are allowed' % API_MAX_NODEIDS), 400
+
+    constitution = request.values.get('constitution')
+    if constitution is not None and constitution not in CONSTITUTIONS:
+        return jsonify(error='constitution must be one of ' + ', '.join(CONSTITUTIONS)), 400
+
+    if nodeids is None and constitution is None:
+        return jsonify(error='nodeid or constitution is required'), 400
+
+    rows = Node.status_rows(get_db(), nodeids=nodeids, constitution=constitution)
+
+    def node_json(row):
+        alarm = None
+        if row.alarm_id is not None:
+            alarm = {'id': row.alarm_id, 'alarm_at': json_time(row.alarm_at)}
+
+        return json.dumps({
+            'nodeid': row.nodeid,
+            'name': row.name,
+            'constitution': 'unknown' if row.is_state_unknown else row.state,
+            'state': row.state,
+            'is_state_unknown': bool(row.is_state_unknown),
+            'last_seen_at': json_time(row.last_seen_at),
+            'open_alarm': alarm,
+        })
+
+    def generate():
+        yield '{"nodes": ['
+        first = True
+        for chunk in rows.partitions(API_CHUNK_ROWS):
+            data = ', '.join(node_json(row) for row in chunk)
+            yield data if first else ', ' + data
+            first = False
+        yield ']}\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# The browsers reconnect after this time, so the threads of the gunicorn
+# workers are not occupied forever.
+EVENTS_STREAM_SECONDS = 300
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_POLL_SECONDS = 1
+# Every open stream holds one of the 32 threads of a gunicorn worker, so only
+# this many streams are kept open per process. The other browsers get the
+# pending events and poll again after EVENTS_RETRY_MS.
+EVENTS_MAX_STREAMS = 8
+EVENTS_RETRY_MS = 30000
+# how long a request waits for the first poll of the node events
+EVENTS_START_SECONDS = 5
+# Maximum number of nodeids in the url of /events, so it stays below the
+# limit_request_line of gunicorn. Pages with more nodes get all events.
+EVENTS_MAX_NODEIDS = 100
+
+class EventBroadcaster:
+    """ Polls the NodeEvent log in a single thread per process and hands the
+    new events to all open event streams, so the number of queries does not
+    grow with the number of connected browsers. The latest events are kept
+    in memory for streams, which reconnect with a Last-Event-ID. """
+
+    def __init__(self, poll_interval=EVENTS_POLL_SECONDS, keep=1000):
+        self.poll_interval = poll_interval
+        self.events = deque(maxlen=keep)
+        self.latest_id = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _poll(self):
+        with Session(bind=get_engine(readonly=True)) as session:
+            if self.latest_id is None:
+                latest_id = NodeEvent.latest_id(session)
+                with self._cond:
+                    self.latest_id = latest_id
+                    self._cond.notify_all()
+                return
+
+            events = NodeEvent.since(session, self.latest_id)
+
+        if events:
+            with self._cond:
+                self.events.extend(events)
+                self.latest_id = events[-1].id
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            try:
+                self._poll()
+            except Exception as e:
+                print("warning: polling the node events failed: %s" % e, file=sys.stderr)
+            time.sleep(self.poll_interval)
+
+    def start(self, timeout):
+        """ Starts the thread, once per process (after gunicorn forked).
+        Returns the id of the latest event, or None, if the first poll has
+        not finished within timeout seconds. """
+
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-broadcaster', daemon=True)
+                self._thread.start()
+
+            self._cond.wait_for(lambda: self.latest_id is not None, timeout)
+            return self.latest_id
+
+    def wait(self, after_id, timeout):
+        """ Returns the events after after_id and the id of the latest event.
+        If there are none, this waits up to timeout seconds for new ones.
+        Events, which are not in memory anymore, are skipped. """
+
+        with self._cond:
+            if self.latest_id <= after_id:
+                self._cond.wait(timeout)
+            return [e for e in self.events if e.id > after_id], self.latest_id
+
+event_broadcaster = EventBroadcaster()
+event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+def event_stream(lines):
+    response = Response(lines, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/events')
+def events():
+    """ Pushes the NodeEvents to the browser as server-sent events, so the
+    pages can update the constitution and the alarms of the nodes in place.
+    Only the events of the given nodeids are sent, and with subscriptions=1
+    also the ones of the nodes the user is subscribed to. Without any of
+    them, all events are sent. """
+
+    nodeids = set(request.args.getlist('nodeid'))
+    if request.args.get('subscriptions') == '1':
+        # see get_sidebar(), the subscriptions are usually cached
+        nodeids |= get_sidebar(get_db(), get_user())['subscribed_nodeids']
+    elif not nodeids:
+        nodeids = None
+    latest_id = event_broadcaster.start(EVENTS_START_SECONDS)
+    if latest_id is None:
+        # the node events could not be read yet, e.g. the db is locked
+        return event_stream(['retry: %d\n\n' % EVENTS_RETRY_MS])
+
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None or last_id > latest_id:
+        last_id = latest_id
+
+    def node_events(events):
+        for e in events:
+            if nodeids is None or e.nodeid in nodeids:
+                yield 'id: %d\nevent: node\ndata: %s\n\n' % (e.id, e.data)
+
+    def generate():
+        nonlocal last_id
+        if not event_streams.acquire(blocking=False):
+            # All streams of this process are taken, so only the pending
+            # events are sent and the browser asks again later.
+            events, latest_id = event_broadcaster.wait(last_id, 0)
+            yield 'retry: %d\n\n' % EVENTS_RETRY_MS
+            yield from node_events(events)
+            # an id without data only sets the Last-Event-ID of the browser
+            yield 'id: %d\n\n' % max(last_id, latest_id)
+            return
+
+        try:
+            # browsers reconnect after this many ms, if the stream is closed
+            yield 'retry: 2000\n\n'
+
+            end = time.monotonic() + EVENTS_STREAM_SECONDS
+            while time.monotonic() < end:
+                events, latest_id = event_broadcaster.wait(last_id, EVENTS_KEEPALIVE_SECONDS)
+                last_id = max(last_id, latest_id)
+
+                lines = list(node_events(events))
+                if not lines:
+                    # keeps proxies from closing the idle connection
+                    yield ': keepalive\n\n'
+                    continue
+
+                yield from lines
+
+            # the browser resumes from here after it has reconnected
+            yield 'id: %d\n\n' % last_id
+        finally:
+            event_streams.release()
+
+    return event_stream(generate())
 
 @app.route('/unsubscribe')
 def unsubscribe():
@@ -301,7 +727,7 @@ def unsubscribe():
     flash(gettext('Sucessfully unsubscribed from %(node)s!', node=node.name), 'info')
 
     if len(node.subscriptions) == 0:
-        db.delete(node)
+        node.delete(db)
         db.commit()
         flash(gettext('Node %(node)s was removed, because nobody subscribes to it anymore.', node=node.name), 'info')
 